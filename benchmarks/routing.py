@@ -0,0 +1,105 @@
+"""
+Routing benchmark : split_by_counterparty on a synthetic inbox.
+
+    python benchmarks/routing.py --rows 200000 --repeat 3
+
+Run from the repository root, with the same environment as main.py (src.config is imported).
+Exits with code 1 if the routing plan contains a Python UDF (map_elements, map_batches, ...).
+"""
+from __future__ import annotations
+
+import os
+import sys
+import time
+import random
+import argparse
+import polars as pl
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.extraction import split_by_counterparty, route_by_counterparty_lazy
+
+
+RULES = {
+
+    f"CP{i}" : {
+        "emails" : {f"ops{j}@cp{i}.com" for j in range(5)},
+        "subject" : f"statement;cash;collateral;cp{i}",
+        "filenames" : {f"cp{i}_cash.xlsx", f"cp{i}_collat.xlsx"},
+    }
+    for i in range(10)
+
+}
+
+
+def synthetic_inbox (rows : int, seed : int = 0) -> pl.DataFrame :
+    """
+    Inbox rows shaped like fetch_inbox_messages output, plus an attachment name column.
+    """
+    rng = random.Random(seed)
+
+    senders = [f"Ops <ops{j}@cp{i}.com>" for i in range(10) for j in range(5)] + ["noreply@other.com", None]
+    subjects = ["Daily Statement", "CASH report", "collateral call", "Hello", None]
+    files = [f"CP{i}_Cash.xlsx" for i in range(10)] + ["logo.png", "terms.pdf", None]
+
+    return pl.DataFrame(
+
+        {
+            "Id" : [f"id-{k}" for k in range(rows)],
+            "Subject" : [rng.choice(subjects) for _ in range(rows)],
+            "From" : [rng.choice(senders) for _ in range(rows)],
+            "Received DateTime" : ["2025-11-12T08:00:00Z"] * rows,
+            "Attachments" : [rng.random() < 0.8 for _ in range(rows)],
+            "Shared Email" : ["shared@example.com"] * rows,
+            "Attachment Name" : [rng.choice(files) for _ in range(rows)],
+        }
+
+    )
+
+
+def check_no_python_udf (lf : pl.LazyFrame) -> bool :
+    """
+    True when the optimized plan is fully native.
+    """
+    plan = lf.explain()
+    udfs = [line.strip() for line in plan.splitlines() if "python_udf" in line or "map_list" in line]
+
+    for line in udfs :
+        print(f"[-] Python UDF in the routing plan : {line}")
+
+    return not udfs
+
+
+def main (rows : int = 200_000, repeat : int = 3) -> int :
+
+    df = synthetic_inbox(rows)
+
+    native = check_no_python_udf(route_by_counterparty_lazy(df.lazy(), RULES, "Attachment Name"))
+    print(f"[{'+' if native else '-'}] Routing plan {'is fully native' if native else 'contains Python UDFs'}")
+
+    for label, frame, streaming in (("eager", df, False), ("lazy + streaming", df.lazy(), True)) :
+
+        timings = []
+
+        for _ in range(repeat) :
+
+            start = time.perf_counter()
+            buckets = split_by_counterparty(frame, RULES, "Attachment Name", streaming=streaming)
+            timings.append(time.perf_counter() - start)
+
+        matched = sum(v.height for k, v in buckets.items() if k != "UNMATCHED")
+        print(f"[*] {label:<17} {rows} rows : best {min(timings):.3f}s over {repeat} run(s), {matched} matched")
+
+    return 0 if native else 1
+
+
+if __name__ == "__main__" :
+
+    parser = argparse.ArgumentParser(description="Benchmark the counterparty routing")
+
+    parser.add_argument("--rows", type=int, default=200_000, help="Synthetic inbox size")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per variant")
+
+    args = parser.parse_args()
+
+    sys.exit(main(rows=args.rows, repeat=args.repeat))
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
 import os
+import json
+import time
 import argparse
 import traceback
 import yfinance as yf
@@ -14,11 +16,15 @@ from typing import Dict, List, Optional, Tuple, Any
 from src.config import (
     SHARED_MAILS, PAIRS, EMAIL_COLUMNS, RAW_DIR_ABS_PATH,
     ATTACH_DIR_ABS_PATH, ALL_FUNDATIONS, ALL_KINDS, CASH_COLUMNS, COLLATERAL_COLUMNS,
-    HISTORY_DIR_ABS_PATH
+    HISTORY_DIR_ABS_PATH, ATTACHMENT_NAME_RULES, COUNTERPARTIES, ROUTING_EXPLAIN
 )
 from src.extraction import split_by_counterparty
 from src.msla import *
-from src.api import call_api_for_pairs
+from src.api import call_api_for_pairs, load_fx_range
+from src.attachments import get_attachment_index, select_attachments, attachment_file_name
+from src.mail_sync import get_mail_sync_state
+from src.raw_dump import write_raw_dump, export_raw_dump_to_excel
+from src.history import append_history, read_history, export_history_to_excel
 from src.utils import *
 
 from src.counterparties.edb import edb_cash, edb_collateral
@@ -57,12 +63,21 @@ def ensure_inputs_for_date (
 
         raw_dir_abs : Optional[str] = None,
         attch_dir_abs : Optional[str] = None,
+
+        inbox_df : Optional[pl.DataFrame] = None,
+        incremental : bool = False,
+        download_workers : int = 8,
     
     ) -> None :
     """
     Only used when cache misses occur and we need to guarantee the local inputs.
     Idempotent. Downloads attachments and updates ./attachments/{BANK}/...
-    We also dump mailbox rows into ./raw/{bank}_{date}.xlsx (optional).
+    We also dump mailbox rows into ./raw/{bank}/{YYYY-MM}.parquet (RAW_DUMP_FORMAT, see raw_dump).
+    inbox_df : messages of that date already fetched (see ensure_inputs_for_dates).
+    incremental : only the messages not processed by a previous run are listed and
+                  downloaded (see MailSyncState); a failed download is retried next run.
+    download_workers : messages whose attachments are downloaded at once, all counterparties
+                       together (see download_routed_attachments).
     """
     token = get_token() if token is None else token
     shared_emails = SHARED_MAILS if shared_emails is None else shared_emails
@@ -71,28 +86,24 @@ def ensure_inputs_for_date (
     raw_dir_abs = RAW_DIR_ABS_PATH if raw_dir_abs is None else raw_dir_abs
     attch_dir_abs = ATTACH_DIR_ABS_PATH if attch_dir_abs is None else attch_dir_abs
 
-    try :
-
-        inbox_df = pl.DataFrame(schema=schema_df)
-
-        for email in shared_emails :
+    sync_state = get_mail_sync_state() if incremental else None
+    failed_ids = set()
 
-            try :
+    try :
 
-                df_email = get_inbox_messages_by_date(date=date, token=token, email=email, with_attach=True)
-                
-                if isinstance(df_email, pl.DataFrame) and not df_email.is_empty() :
-                    inbox_df = pl.concat([inbox_df, df_email], how="vertical_relaxed")
+        if inbox_df is None :
+            inbox_df = fetch_inbox_messages([date], token, shared_emails, with_attach=True, schema_df=schema_df, sync_state=sync_state)
 
-            except Exception as e:
-                print(f"\n[-] Inbox read error {email} {date}: {e}")
+        if sync_state is not None :
+            inbox_df = sync_state.new_messages(inbox_df)
 
         if inbox_df.is_empty() :
 
-            print(f"\n[-] No inbox data on {date}.")
+            print(f"\n[-] No {'new ' if incremental else ''}inbox data on {date}.")
             return
 
-        rules_map = split_by_counterparty(inbox_df)
+        rules_map = split_by_counterparty(inbox_df, explain=ROUTING_EXPLAIN)
+        jobs : List[Tuple[str, Dict[str, Any]]] = []
 
         # Here
         # k => counterparty name
@@ -102,31 +113,21 @@ def ensure_inputs_for_date (
             if counterparty == "UNMATCHED" or df_cp.is_empty() :
                 continue
 
-            raw_out = os.path.join(raw_dir_abs, f"{counterparty.lower()}_{date}.xlsx")
-            
             try :
-                df_cp.write_excel(raw_out)
+                write_raw_dump(df_cp, counterparty, date, raw_dir_abs=raw_dir_abs)
 
             except Exception as e :
-                print(f"[-] Failed writing {raw_out}: {e}")
+                print(f"[-] Failed writing the raw dump of {counterparty} {date}: {e}")
 
-            for row in df_cp.to_dicts() :
+            jobs.extend((counterparty, row) for row in df_cp.to_dicts() if row.get("Id"))
 
-                msg_id = row.get("Id")
-                origin = row.get("Shared Email")
+        failed_ids = download_routed_attachments(jobs, token, attch_dir_abs, date, max_workers=download_workers)
 
-                if not msg_id :
-                    continue
-
-                try :
+        if sync_state is not None :
 
-                    dest = os.path.join(attch_dir_abs, counterparty)
-                    os.makedirs(dest, exist_ok=True)
-
-                    download_attachments_for_message(msg_id, token, dest, origin)
-                
-                except Exception as e :
-                    print(f"[-] Attachment download failed for {counterparty} {date}: {e}")
+            failed = pl.col("Id").is_in(list(failed_ids))
+            sync_state.mark_processed(inbox_df.filter(~failed), inbox_df.filter(failed))
+            sync_state.flush()
 
     except Exception as e :
 
@@ -136,6 +137,205 @@ def ensure_inputs_for_date (
     return None
 
 
+def download_routed_attachments (
+
+        jobs : List[Tuple[str, Dict[str, Any]]],
+        token : Optional[str] = None,
+        attch_dir_abs : Optional[str] = None,
+        date : Optional[str] = None,
+
+        max_workers : int = 8,
+
+    ) -> set :
+    """
+    Download the attachments of every routed message, (counterparty, inbox row) jobs, with
+    a bounded pool shared by all counterparties. Graph requests stay limited per mailbox
+    (see mailbox_slot). Prints per counterparty the files/bytes downloaded and the files
+    skipped (already on disk), with the wall-clock time from the submission to its last
+    completed message and the summed worker time, and returns the ids of the messages
+    that failed.
+
+    Messages that write the same file (same attachment name in the same folder, e.g. a
+    corrected statement re-sent under the same name) run one after the other in
+    receivedDateTime order, so the latest message wins, as with the sequential loop.
+    """
+    attch_dir_abs = ATTACH_DIR_ABS_PATH if attch_dir_abs is None else attch_dir_abs
+
+    failed_ids = set()
+    summary : Dict[str, Dict[str, float]] = {}
+
+    if not jobs :
+        return failed_ids
+
+    def _download (counterparty : str, row : Dict[str, Any]) -> Tuple[List[str], List[str]] :
+
+        dest = os.path.join(attch_dir_abs, counterparty)
+        os.makedirs(dest, exist_ok=True)
+
+        meta = json.loads(row["Attachments Meta"]) if row.get("Attachments Meta") else None
+
+        return download_attachments_for_message(
+            row["Id"], token, dest, row.get("Shared Email"), attachments_meta=meta,
+            name_rules=ATTACHMENT_NAME_RULES.get(counterparty)
+        )
+
+    def _download_chain (chain : List[Tuple[str, Dict[str, Any]]]) -> List[Tuple[str, str, Tuple[List[str], List[str]], Optional[Exception], float, float]] :
+
+        results = []
+
+        for counterparty, row in chain :
+
+            start = time.perf_counter()
+
+            try :
+                result, error = _download(counterparty, row), None
+
+            except Exception as e :
+                result, error = ([], []), e
+
+            done = time.perf_counter()
+            results.append((counterparty, row["Id"], result, error, done - start, done))
+
+        return results
+
+    with ThreadPoolExecutor(max_workers=max_workers) as ex :
+
+        submitted = time.perf_counter()
+        futures = [ex.submit(_download_chain, chain) for chain in same_file_chains(jobs, attch_dir_abs)]
+
+        for fut in as_completed(futures) :
+
+            for counterparty, msg_id, (paths, skipped), error, elapsed, done in fut.result() :
+
+                stats = summary.setdefault(counterparty, {"messages" : 0, "files" : 0, "bytes" : 0, "skipped" : 0, "wall" : 0.0, "busy" : 0.0})
+                stats["messages"] += 1
+                stats["wall"] = max(stats["wall"], done - submitted)
+
+                if error is not None :
+
+                    failed_ids.add(msg_id)
+                    print(f"[-] Attachment download failed for {counterparty} {date}: {error}")
+                    continue
+
+                stats["files"] += len(paths)
+                stats["skipped"] += len(skipped)
+                stats["bytes"] += sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+                stats["busy"] += elapsed
+
+    for counterparty, stats in sorted(summary.items()) :
+
+        get_attachment_index().invalidate(os.path.join(attch_dir_abs, counterparty))
+
+        print(
+            f"[+] {counterparty} {date} : {stats['messages']} message(s), {stats['files']} file(s) "
+            f"downloaded ({stats['bytes'] / 1e6:.2f} MB), {stats['skipped']} already on disk, "
+            f"{stats['wall']:.1f}s wall ({stats['busy']:.1f}s summed worker time)"
+        )
+
+    return failed_ids
+
+
+def same_file_chains (
+
+        jobs : List[Tuple[str, Dict[str, Any]]],
+        attch_dir_abs : Optional[str] = None,
+
+    ) -> List[List[Tuple[str, Dict[str, Any]]]] :
+    """
+    Group the (counterparty, inbox row) jobs that may write the same file : two messages
+    are chained when they carry an attachment of the same name for the same folder.
+    Messages listed without "Attachments Meta" have unknown names and are chained with
+    every message of their folder. Each chain is sorted by receivedDateTime.
+    """
+    attch_dir_abs = ATTACH_DIR_ABS_PATH if attch_dir_abs is None else attch_dir_abs
+
+    parent = list(range(len(jobs)))
+
+    def _find (i : int) -> int :
+
+        while parent[i] != i :
+
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+
+        return i
+
+    metas = [json.loads(row["Attachments Meta"]) if row.get("Attachments Meta") else None for _, row in jobs]
+    blind = {counterparty for (counterparty, _), meta in zip(jobs, metas) if meta is None}
+
+    owners : Dict[str, int] = {}
+
+    for i, ((counterparty, row), meta) in enumerate(zip(jobs, metas)) :
+
+        dest = os.path.join(attch_dir_abs, counterparty)
+
+        if counterparty in blind :
+            keys = [dest]
+
+        else :
+
+            wanted = select_attachments(meta, ATTACHMENT_NAME_RULES.get(counterparty))
+            keys = [os.path.join(dest, attachment_file_name(att)) for att in wanted]
+
+        for key in map(os.path.normcase, keys) :
+
+            if key in owners :
+                parent[_find(i)] = _find(owners[key])
+
+            else :
+                owners[key] = i
+
+    chains : Dict[int, List[Tuple[str, Dict[str, Any]]]] = {}
+
+    for i, job in enumerate(jobs) :
+        chains.setdefault(_find(i), []).append(job)
+
+    return [
+        sorted(chain, key=lambda job : job[1].get("Received DateTime") or "")
+        for chain in chains.values()
+    ]
+
+
+def ensure_inputs_for_dates (
+        
+        dates : Optional[List[str]] = None,
+        token : Optional[str] = None,
+        
+        shared_emails : Optional[List[str]] = None,
+        schema_df : Optional[Dict[str, Any]] = None,
+
+        max_workers : int = 4,
+        chunk_days : Optional[int] = 7,
+        incremental : bool = False,
+    
+    ) -> None :
+    """
+    Fetch the inboxes of every (mailbox, date) concurrently, then route and download
+    the attachments date by date with ensure_inputs_for_date.
+
+    With several dates, the inboxes are listed by `chunk_days` windows (one Graph query
+    per window and mailbox) instead of one query per day; chunk_days=None lists per day.
+    incremental : list each (mailbox, day) from its watermark and skip the messages
+                  already processed (see ensure_inputs_for_date).
+    """
+    dates = [date_to_str()] if dates is None else dates
+    token = get_token() if token is None else token
+    schema_df = EMAIL_COLUMNS if schema_df is None else schema_df
+
+    chunk_days = chunk_days if len(dates) > 1 else None
+
+    sync_state = get_mail_sync_state() if incremental else None
+
+    inbox_df = fetch_inbox_messages(
+        dates, token, shared_emails, with_attach=True, schema_df=schema_df,
+        max_workers=max_workers, chunk_days=chunk_days, sync_state=sync_state
+    )
+    by_day = partition_inbox_by_day(inbox_df, dates)
+
+    for d in dates :
+        ensure_inputs_for_date(d, token, shared_emails, schema_df, inbox_df=by_day[d], incremental=incremental)
+
+
 def look_inputs_from_history (
         
         start_date : Optional[str | dt.datetime | dt.date] = None,
@@ -164,12 +364,7 @@ def look_inputs_from_history (
 
         for kind in kinds :
 
-            h = load_history(fund, kind)
-            if h is None :
-                print("No history")
-                break
-
-            slice_df = slice_history(h, start_date, end_date)
+            slice_df = read_history(fund, kind, start_date, end_date)
 
             if slice_df.is_empty() :
                 all_from_history = False
@@ -190,9 +385,16 @@ def main(start_date: Optional[str | dt.datetime] = None,
          kinds: Optional[str | List[str]] = None,
          shared_emails: Optional[List[str]] = None,
          pairs: Optional[List[str]] = None,
-         schema_df: Optional[Dict] = None) -> None:
+         schema_df: Optional[Dict] = None,
+         batch: bool = True,
+         incremental: bool = False,
+         raw_excel: bool = False) -> None:
     """
     Main entry point
+    batch: accumulate the blocks of every (date, fund) and merge them into history once
+           per run instead of once per processed day.
+    incremental: only fetch the messages received since the previous run (mail sync state).
+    raw_excel: also render the raw inbox dumps as raw/{bank}_{date}.xlsx (audit).
     """
     start_date = date_to_str(start_date)
     end_date = date_to_str(end_date)
@@ -206,16 +408,18 @@ def main(start_date: Optional[str | dt.datetime] = None,
         print(f"\n[-] Error during date range generation.")
         return None
 
-    # FX/close values once (you can also refresh per day if needed)
-    close_values = call_api_for_pairs(None, pairs)
-    print(f"\n[*] FX close values: {close_values}")
+    # FX/close values for every day of the range, one bulk download (or none if cached)
+    fx_table = load_fx_range(dates[0], dates[-1], pairs)
 
     # Optionally prefetch inputs (mail/attachments)
     # token = get_token() if token is None else token
     # shared_emails = SHARED_MAILS if shared_emails is None else shared_emails
     # schema_df = EMAIL_COLUMNS if schema_df is None else schema_df
-    for d in dates:
-        ensure_inputs_for_date(d, token, shared_emails, schema_df)
+    ensure_inputs_for_dates(dates, token, shared_emails, schema_df, incremental=incremental)
+
+    if raw_excel:
+        for d in dates:
+            export_raw_dump_to_excel(list(COUNTERPARTIES.keys()), d)
 
     # Kinds filter: None -> both cash & collateral; else normalize to a set
 
@@ -227,12 +431,29 @@ def main(start_date: Optional[str | dt.datetime] = None,
     else:
         kinds_filter = {k.lower() for k in kinds}
 
+    pending: Dict[Tuple[str, str], List[pl.DataFrame]] = {}
+
     for d in dates:
+        close_values = fx_table.get(d) or call_api_for_pairs(d, pairs)
+        print(f"\n[*] FX close values at {d}: {close_values}")
+
         for f in fundations:
             print(f"\n[+] Processing date = {d} fund = {f} ...")
-            process_one_day_fund(d, f, close_values, kinds_filter=kinds_filter, max_workers=8)
+            blocks = process_one_day_fund(d, f, close_values, kinds_filter=kinds_filter, max_workers=8,
+                                          write_history=not batch)
+            if batch:
+                for kind, block in blocks.items():
+                    pending.setdefault((f, kind), []).append(block)
     #"""
 
+    flush_history(pending)
+
+    # Excel rendering happens once, after all days have been merged
+    export_history_to_excel(fundations, sorted(kinds_filter) if kinds_filter else None)
+
+    # Write-behind : cached file lookups of this run reach the disk once
+    get_file_cache().flush()
+
     #df = ms_cash("2025-11-12", "HV", close_values)
     #print(df)
     #filepath = df.write_excel("goldman-collat.xlsx")
@@ -318,59 +539,17 @@ def run_all_in_parallel(date: str,
 
 
 
-def _filename_for_kind(kind: str) -> str:
-    return f"{kind}.xlsx"  # => cash.xlsx / collateral.xlsx
-
-
-def _schema_for_kind(kind: str) -> Dict[str, Any]:
-    """
-    Return the appropriate schema dict for Polars read/write,
-    based on whether we're dealing with cash or collateral.
-    """
-    if kind == "cash":
-        return CASH_COLUMNS
-    elif kind == "collateral":
-        return COLLATERAL_COLUMNS
-    else:
-        raise ValueError(f"Unknown kind: {kind}")
-
-
-def _read_history(fund: str, kind: str) -> pl.DataFrame:
-    os.makedirs(os.path.join(HISTORY_DIR_ABS_PATH, fund.upper()), exist_ok=True)
-    path = os.path.join(HISTORY_DIR_ABS_PATH, fund.upper(), _filename_for_kind(kind))
-    schema = _schema_for_kind(kind)
-    if os.path.exists(path):
-        try:
-            return pl.read_excel(path, schema_overrides=schema)
-        except Exception as e:
-            print(f"[-] Failed to read history {path}: {e}")
-            return pl.DataFrame(schema=schema)
-    return pl.DataFrame(schema=schema)
-
-
-def _write_history(fund: str, kind: str, df: pl.DataFrame) -> None:
-    path = os.path.join(HISTORY_DIR_ABS_PATH, fund.upper(), _filename_for_kind(kind))
-    if not os.path.exists(path) :
-        """
-        
-        """
-        parent = os.path.dirname(path)
-        os.makedirs(parent, exist_ok=True)
-    try:
-        # exact-duplicate drop; keep order if available
-        df = df.unique(maintain_order=True)
-        df.write_excel(path)
-    except Exception as e:
-        print(f"[-] Failed writing {path}: {e}")
-
 def process_one_day_fund(date: str,
                          fundation: str,
                          close_values: Dict[str, float],
                          kinds_filter: Optional[set[str]] = None,
                          *,
-                         max_workers: int = 8) -> None:
+                         max_workers: int = 8,
+                         write_history: bool = True) -> Dict[str, pl.DataFrame]:
     """
-    Runs all bank functions for one (date, fundation), groups by kind, and updates history files.
+    Runs all bank functions for one (date, fundation) and groups by kind.
+    Returns {kind: DataFrame}. When write_history is False the blocks are only returned,
+    so the caller can merge a whole date range into history at once (see flush_history).
     """
     results = run_all_in_parallel(
         date=date,
@@ -390,20 +569,29 @@ def process_one_day_fund(date: str,
             continue
         grouped[kind].append(df)
 
+    blocks: Dict[str, pl.DataFrame] = {}
+
     for kind, dfs in grouped.items():
         if not dfs:
             continue
         new_block = pl.concat(dfs, how="vertical_relaxed")
+        blocks[kind] = new_block
+
+        if write_history:
+            # Only the monthly partitions of this date are rewritten
+            append_history(new_block, fundation, kind)
 
-        # Read existing history and append
-        history = _read_history(fundation, kind)
-        if history.is_empty():
-            merged = new_block
-        else:
-            # Relaxed concat to accommodate minor schema diffs
-            merged = pl.concat([history, new_block], how="vertical_relaxed")
+    return blocks
 
-        _write_history(fundation, kind, merged)
+
+def flush_history(pending: Dict[Tuple[str, str], List[pl.DataFrame]]) -> None:
+    """
+    Merge the blocks accumulated per (fundation, kind) into history, one append per pair.
+    """
+    for (fundation, kind), dfs in pending.items():
+        if not dfs:
+            continue
+        append_history(pl.concat(dfs, how="vertical_relaxed"), fundation, kind)
 
 
 
@@ -429,6 +617,14 @@ if __name__ == '__main__' :
         "--fund", required=False, help="Fundation name initials."
 
     )
+
+    parser.add_argument(
+        "--incremental", action="store_true", help="Only fetch messages not processed by a previous run"
+    )
+
+    parser.add_argument(
+        "--raw-excel", action="store_true", help="Also render the raw inbox dumps as Excel files"
+    )
     
     args = parser.parse_args()
 
@@ -438,6 +634,8 @@ if __name__ == '__main__' :
         shared_emails=args.shared_emails,
         start_date=args.start_date,
         end_date=args.end_date,
-        fundation=args.fund
+        fundation=args.fund,
+        incremental=args.incremental,
+        raw_excel=args.raw_excel
     
     )
\ No newline at end of file
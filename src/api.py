@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import time
 import pandas as pd # type: ignore
 import polars as pl
 import yfinance as yf
@@ -9,19 +10,27 @@ from typing import Optional, List, Dict
 
 from src.config import PAIRS
 from src.utils import date_to_str
+from src.fx_cache import FxCache, get_fx_cache
 
 
 def call_api_for_pairs (
     
         target_date : Optional[str | dt.datetime] = None,
         pairs : Optional[List[str]] = None,
-        loopback : int = 3
+        loopback : int = 3,
+        backoff : float = 1.0,
+        max_backoff : float = 8.0
     
     ) -> Optional[Dict[str, float]] :
     """
-    
+    Close values for the pairs at target_date, normalized ({'USD': 1.10, ...}).
+    Served from the FX cache when possible; a download is only made on a cache miss.
+
+    When some pairs come back NaN, only those pairs are re-requested, at most
+    `loopback - 1` more times with a bounded exponential backoff. Pairs still missing
+    after that take the nearest prior cached rate.
     """
-    if loopback == 0 :
+    if loopback <= 0 :
 
         print("\n[-] YFinance API error. Reload the script")
         return None
@@ -29,27 +38,297 @@ def call_api_for_pairs (
     pairs = PAIRS if pairs is None else pairs
     target_date = date_to_str(target_date)
 
+    cache = get_fx_cache()
+    cached = cache.get(target_date, pairs)
+
+    if cached is not None :
+        return normalize_fx_dict(cached)
+
+    if cache.offline :
+
+        print(f"\n[-] No FX rates for {target_date} in the offline fixture {cache.fixture}")
+        return None
+
     conversion = yf.download(tickers=pairs, start=target_date, progress=False, threads=True, auto_adjust=False)
 
-    conversion.index = pd.to_datetime(conversion.index)
+    close_values = _close_values_at(conversion, target_date, pairs)
+    missing = missing_pairs(close_values)
+
+    for attempt in range(loopback - 1) :
 
-    if target_date in conversion.index :
-        row = conversion.loc[target_date]
+        if not missing :
+            break
+
+        delay = min(backoff * (2 ** attempt), max_backoff)
+        print(f"\n[!] Missing value for {missing}. Retrying those pairs in {delay:.0f}s...")
+        time.sleep(delay)
+
+        retry = yf.download(tickers=missing, start=target_date, progress=False, threads=True, auto_adjust=False)
         
-    else :
-        row = conversion.loc[conversion.index.get_indexer([target_date], method="nearest")][0]
+        for pair, val in _close_values_at(retry, target_date, missing).items() :
+
+            if not pd.isna(val) :
+                close_values[pair] = val
+
+        missing = missing_pairs(close_values)
+
+    # Every complete past row of the download is worth keeping, today's values are still moving
+    today = date_to_str()
+
+    if conversion is not None and not conversion.empty :
 
-    close_values = row["Close"].to_dict()
+        closes = conversion["Close"].dropna(how="any")
 
-    if check_nan_into_values(target_date, pairs, close_values) :
+        past_rows = {
+            date_to_str(idx.to_pydatetime()) : row.to_dict()
+            for idx, row in closes.iterrows() if date_to_str(idx.to_pydatetime()) < today
+        }
 
-        print("\n[!] Missing value for conversion. Retrying...")
-        return call_api_for_pairs(target_date, pairs, loopback - 1)
+        cache.put_many(past_rows)
+
+    # The nearest row (e.g. Monday for a Sunday) only answers this call, the disk keeps exact dates
+    cache.put(target_date, close_values, persist=target_date < today and _has_row_at(conversion, target_date))
+
+    for pair in missing :
+
+        prior = cache.latest_before(target_date, pair)
+
+        if prior is None :
+            print(f"\n[-] No value for {pair} at {target_date} and no prior cached rate")
+            continue
+
+        print(f"\n[!] {pair} still missing at {target_date}, using the prior cached rate {prior}")
+        close_values[pair] = prior
 
     print(f"\n[+] Close values at {target_date} :")
     return normalize_fx_dict(close_values)
 
 
+def _close_values_at (
+        
+        conversion : Optional[pd.DataFrame],
+        target_date : str,
+        pairs : List[str]
+    
+    ) -> Dict[str, float] :
+    """
+    {pair: close} of the row at target_date (or the nearest row). Missing pairs are NaN.
+    """
+    out : Dict[str, float] = {p : float("nan") for p in pairs}
+
+    if conversion is None or conversion.empty :
+        return out
+
+    closes = conversion["Close"]
+
+    if isinstance(closes, pd.Series) :
+        closes = closes.to_frame(pairs[0])
+
+    closes.index = pd.to_datetime(closes.index).tz_localize(None)
+    target = pd.Timestamp(target_date)
+
+    if target in closes.index :
+        row = closes.loc[target]
+
+    else :
+        row = closes.iloc[closes.index.get_indexer([target], method="nearest")[0]]
+
+    if isinstance(row, pd.DataFrame) :
+        row = row.iloc[-1]
+
+    out.update({p : v for p, v in row.to_dict().items() if p in out})
+
+    return out
+
+
+def _has_row_at (conversion : Optional[pd.DataFrame], target_date : str) -> bool :
+    """
+    True if the download has a row dated exactly target_date.
+    """
+    if conversion is None or conversion.empty :
+        return False
+
+    index = pd.to_datetime(conversion.index).tz_localize(None).normalize()
+
+    return pd.Timestamp(target_date) in index
+
+
+def missing_pairs (values : Optional[Dict[str, float]] = None) -> List[str] :
+    """
+    Return the pairs whose value is missing (None/NaN).
+    """
+    if values is None :
+        return []
+
+    return [p for p, v in values.items() if v is None or pd.isna(v)]
+
+
+def load_fx_range (
+    
+        start_date : Optional[str | dt.datetime] = None,
+        end_date : Optional[str | dt.datetime] = None,
+        pairs : Optional[List[str]] = None,
+        lookback_days : int = 7,
+        loopback : int = 3,
+        backoff : float = 1.0,
+        max_backoff : float = 8.0
+    
+    ) -> Dict[str, Dict[str, float]] :
+    """
+    Per-date FX table for a whole window: {'2025-11-12': {'EUR': 1.0, 'USD': 1.15, ...}, ...}
+
+    The pairs the FX cache cannot serve for every calendar day are downloaded over
+    [start_date - lookback_days, end_date] in one request, holidays and weekends are
+    forward-filled from the previous close, and the result is stored in the FX cache.
+
+    Pairs absent from the download are re-requested over the window (same bounded backoff
+    as call_api_for_pairs), then take the nearest prior cached rate. The offline fixture
+    applies the same prior-rate fill to the days it lacks. A pair still missing after that
+    is reported once and left out of the day dicts, the other pairs are kept and cached.
+    """
+    pairs = PAIRS if pairs is None else pairs
+
+    start = dt.datetime.strptime(date_to_str(start_date), "%Y-%m-%d")
+    end = dt.datetime.strptime(date_to_str(end_date), "%Y-%m-%d")
+
+    if start > end :
+        start, end = end, start
+
+    days = [date_to_str(start + dt.timedelta(days=i)) for i in range((end - start).days + 1)]
+
+    cache = get_fx_cache()
+    known = {d : {p : (cache.get(d, [p]) or {}).get(p, float("nan")) for p in pairs} for d in days}
+    lacking = [p for p in pairs if any(pd.isna(values[p]) for values in known.values())]
+
+    if lacking and not cache.offline :
+
+        first = start - dt.timedelta(days=lookback_days)
+        closes = _download_closes(lacking, first, end)
+
+        if closes is None :
+            print(f"\n[-] YFinance returned no data for {lacking} between {date_to_str(first)} and {date_to_str(end)}")
+
+        missing = lacking if closes is None else [p for p in lacking if closes.loc[start:end, p].isna().any()]
+
+        for attempt in range(loopback - 1) :
+
+            if not missing :
+                break
+
+            delay = min(backoff * (2 ** attempt), max_backoff)
+            print(f"\n[!] Missing values for {missing} between {days[0]} and {days[-1]}. Retrying those pairs in {delay:.0f}s...")
+            time.sleep(delay)
+
+            retry = _download_closes(missing, first, end)
+
+            if retry is not None and closes is None :
+                closes = retry
+
+            elif retry is not None :
+                closes[missing] = closes[missing].fillna(retry[missing])
+
+            missing = lacking if closes is None else [p for p in lacking if closes.loc[start:end, p].isna().any()]
+
+        if closes is not None :
+
+            for idx, row in closes.loc[start:end].iterrows() :
+
+                values = known[date_to_str(idx.to_pydatetime())]
+                values.update({p : row[p] for p in lacking if pd.isna(values[p])})
+
+    today = date_to_str()
+    table : Dict[str, Dict[str, float]] = {}
+    dead : set = set()
+    empty : List[str] = []
+
+    for d, values in known.items() :
+
+        # Pairs still missing take the prior cached rate, the rule used for weekends
+        still_missing = _fill_from_prior(values, d, cache)
+
+        if len(still_missing) == len(values) :
+
+            empty.append(d)
+            continue
+
+        dead.update(still_missing)
+
+        if lacking and not cache.offline :
+            cache.put(d, values, persist=d < today)
+
+        table[d] = normalize_fx_dict(values)
+
+    if dead :
+        print(f"\n[-] No rate for {sorted(dead)} between {days[0]} and {days[-1]} (even prior), amounts in those currencies stay empty")
+
+    if empty :
+        print(f"\n[-] No FX rates at all for {len(empty)} day(s) (first: {empty[0]})")
+
+    print(f"\n[+] FX rates loaded for {len(table)} day(s) between {days[0]} and {days[-1]}")
+
+    return table
+
+
+def _download_closes (
+
+        pairs : List[str],
+        first : dt.datetime,
+        end : dt.datetime
+
+    ) -> Optional[pd.DataFrame] :
+    """
+    Close values of the pairs for every calendar day of [first, end], one column per pair
+    (NaN for a pair the download lacks). Holidays/weekends take the previous close, or the
+    next one at the very start.
+    """
+    conversion = yf.download(
+        
+        tickers=pairs,
+        start=date_to_str(first),
+        end=date_to_str(end + dt.timedelta(days=1)), # end is exclusive
+        progress=False,
+        threads=True,
+        auto_adjust=False
+    
+    )
+
+    if conversion is None or conversion.empty :
+        return None
+
+    closes = conversion["Close"]
+
+    if isinstance(closes, pd.Series) :
+        closes = closes.to_frame(pairs[0])
+
+    closes.index = pd.to_datetime(closes.index).tz_localize(None).normalize()
+    closes = closes[~closes.index.duplicated(keep="last")]
+
+    calendar = pd.date_range(first, end, freq="D")
+
+    return closes.reindex(index=calendar, columns=pairs).ffill().bfill()
+
+
+def _fill_from_prior (
+
+        values : Dict[str, float],
+        target_date : str,
+        cache : FxCache
+
+    ) -> List[str] :
+    """
+    Fill the missing pairs of `values` in place with the nearest prior cached rate.
+    Returns the pairs still missing.
+    """
+    for pair in missing_pairs(values) :
+
+        prior = cache.latest_before(target_date, pair)
+
+        if prior is not None :
+            values[pair] = prior
+
+    return missing_pairs(values)
+
+
 def check_nan_into_values (
         
         target_date : Optional[str | dt.datetime] = None,
@@ -58,16 +337,13 @@ def check_nan_into_values (
     
     ) -> bool :
     """
-    
+    True if any conversion value is missing. No values at all counts as missing
+    (nothing is downloaded here).
     """
-    conversion = call_api_for_pairs(target_date, pairs) if conversion is None else conversion
-
-    for v in conversion.values() :
-
-        if pd.isna(v) :
-            return True
+    if conversion is None :
+        return True
 
-    return False
+    return len(missing_pairs(conversion)) > 0
 
 
 def normalize_fx_dict (raw_fx : Optional[Dict[str, float]] = None, ends_with : str = "-X", start_with = "EUR") -> Optional[Dict[str, float]] :
@@ -0,0 +1,488 @@
+from __future__ import annotations
+
+import os
+import re
+import json
+import hashlib
+import threading
+import datetime as dt
+
+from typing import Optional, Dict, List, Tuple, Any, Callable
+
+from src.config import ATTACHMENT_MANIFEST_FILENAME_ABS
+from src.utils import date_to_str, write_atomic
+
+
+# strftime directive -> regex of the text it produces
+FORMAT_TOKENS = {
+
+    "%Y" : r"\d{4}",
+    "%y" : r"\d{2}",
+    "%m" : r"\d{2}",
+    "%d" : r"\d{2}",
+    "%b" : r"[A-Za-z]{3}",
+    "%B" : r"[A-Za-z]{3,9}",
+
+}
+
+
+def format_to_regex (d_format : str = "%Y%m%d") -> re.Pattern :
+    """
+    Build a regex matching every (possibly overlapping) substring that could be
+    produced by `d_format`, e.g. "%d_%b_%Y" -> (?=(\\d{2}_[A-Za-z]{3}_\\d{4}))
+    """
+    parts = re.split(r"(%[A-Za-z])", d_format)
+    body = "".join(FORMAT_TOKENS.get(p, re.escape(p)) if p.startswith("%") else re.escape(p) for p in parts if p)
+
+    return re.compile(rf"(?=({body}))")
+
+
+class AttachmentIndex :
+    """
+    Per-directory index of attachment filenames.
+
+    The listing of a directory is read once and kept until the directory mtime changes
+    (files added, removed or renamed). For each date format, the dates written in the
+    filenames are parsed once, so `lookup` answers "which files carry this date" with a
+    dict access instead of a listdir + substring scan per (date, fund, kind).
+    """
+
+    def __init__ (self) -> None :
+
+        self._lock = threading.RLock()
+
+        # dir -> (mtime_ns, entries in listdir order)
+        self._listings : Dict[str, Tuple[int, List[str]]] = {}
+
+        # (dir, d_format) -> {formatted date : entries}
+        self._by_date : Dict[Tuple[str, str], Dict[str, List[str]]] = {}
+
+
+    @staticmethod
+    def _key (dir_abs_path : str) -> str :
+        return os.path.normcase(os.path.abspath(dir_abs_path))
+
+
+    def invalidate (self, dir_abs_path : Optional[str] = None) -> None :
+        """
+        Forget a directory (or every directory when None), it is re-listed on next access.
+        """
+        with self._lock :
+
+            if dir_abs_path is None :
+
+                self._listings.clear()
+                self._by_date.clear()
+                return
+
+            key = self._key(dir_abs_path)
+            self._listings.pop(key, None)
+
+            for k in [k for k in self._by_date if k[0] == key] :
+                del self._by_date[k]
+
+
+    def entries (self, dir_abs_path : str) -> List[str] :
+        """
+        Cached os.listdir(dir_abs_path), refreshed when the directory mtime changes.
+        """
+        key = self._key(dir_abs_path)
+
+        try :
+            mtime = os.stat(dir_abs_path).st_mtime_ns
+
+        except OSError :
+            return []
+
+        with self._lock :
+
+            cached = self._listings.get(key)
+
+            if cached is not None and cached[0] == mtime :
+                return cached[1]
+
+            entries = os.listdir(dir_abs_path)
+            self._listings[key] = (mtime, entries)
+
+            for k in [k for k in self._by_date if k[0] == key] :
+                del self._by_date[k]
+
+            return entries
+
+
+    def lookup (
+
+            self,
+            dir_abs_path : str,
+            date : Optional[str | dt.date | dt.datetime] = None,
+            d_format : str = "%Y%m%d",
+
+        ) -> List[str] :
+        """
+        Entries whose name contains `date` written with `d_format` (listdir order kept).
+        Equivalent to [e for e in os.listdir(dir) if date_to_str(date, d_format) in e].
+        """
+        token = date_to_str(date, d_format)
+        entries = self.entries(dir_abs_path)
+        key = (self._key(dir_abs_path), d_format)
+
+        with self._lock :
+
+            by_date = self._by_date.get(key)
+
+            if by_date is None :
+
+                by_date = self._build(entries, d_format)
+                self._by_date[key] = by_date
+
+            return by_date.get(token, [])
+
+
+    @staticmethod
+    def _build (entries : List[str], d_format : str) -> Dict[str, List[str]] :
+        """
+        Parse the dates of every filename once.
+        """
+        pattern = format_to_regex(d_format)
+        out : Dict[str, List[str]] = {}
+
+        for entry in entries :
+
+            seen = set()
+
+            for m in pattern.finditer(entry) :
+
+                text = m.group(1)
+
+                if text in seen :
+                    continue
+
+                try :
+                    parsed = dt.datetime.strptime(text, d_format)
+
+                except ValueError :
+                    continue
+
+                # Same text as date_to_str would produce (zero padding, month case)
+                if parsed.strftime(d_format) != text :
+                    continue
+
+                seen.add(text)
+                out.setdefault(text, []).append(entry)
+
+        return out
+
+
+class FileMetadataCache :
+    """
+    Persisted sidecar of per-file metadata : {path : {"size", "mtime_ns", **meta}}
+
+    `meta` is produced by an extractor that has to open the file (sheet names, statement
+    date, ...). It runs once per file version : an entry is reused as long as the size and
+    mtime of the file are unchanged, across runs since the sidecar is a JSON file on disk.
+    """
+
+    def __init__ (self, filename : Optional[str] = None) -> None :
+
+        self.filename = filename
+
+        self._lock = threading.RLock()
+        self._entries : Optional[Dict[str, Dict[str, Any]]] = None
+
+
+    def _load (self) -> Dict[str, Dict[str, Any]] :
+
+        if self._entries is not None :
+            return self._entries
+
+        self._entries = {}
+
+        if not self.filename or not os.path.exists(self.filename) :
+            return self._entries
+
+        try :
+
+            with open(self.filename, "r", encoding="utf-8") as f :
+                self._entries = json.load(f)
+
+        except Exception as e :
+            print(f"[-] Failed to read metadata sidecar {self.filename}: {e}")
+
+        return self._entries
+
+
+    def _flush (self) -> None :
+        """
+        Rewrite the sidecar atomically (temp file + rename).
+        """
+        if not self.filename :
+            return
+
+        def _dump (tmp : str) -> None :
+
+            with open(tmp, "w", encoding="utf-8") as f :
+                json.dump(self._entries, f, ensure_ascii=False, indent=1, default=str)
+
+        try :
+            write_atomic(self.filename, _dump)
+
+        except Exception as e :
+            print(f"[-] Failed writing metadata sidecar {self.filename}: {e}")
+
+
+    def get (
+
+            self,
+            file_abs_path : str,
+            extractor : Callable[[str], Dict[str, Any]],
+
+        ) -> Optional[Dict[str, Any]] :
+        """
+        Metadata of a file, extracted (i.e. the file opened) only if unknown or modified.
+        """
+        try :
+            st = os.stat(file_abs_path)
+
+        except OSError :
+            return None
+
+        key = os.path.normcase(os.path.abspath(file_abs_path))
+
+        with self._lock :
+
+            entry = self._load().get(key)
+
+            if entry is not None and entry.get("size") == st.st_size and entry.get("mtime_ns") == st.st_mtime_ns :
+                return entry
+
+        try :
+            meta = extractor(file_abs_path)
+
+        except Exception as e :
+
+            print(f"[-] Failed to read metadata of {file_abs_path}: {e}")
+            meta = {}
+
+        entry = {**meta, "size" : st.st_size, "mtime_ns" : st.st_mtime_ns}
+
+        with self._lock :
+
+            self._load()[key] = entry
+            self._flush()
+
+        return entry
+
+
+def select_attachments (
+
+        attachments : Optional[List[Dict[str, Any]]] = None,
+        rules : Optional[List[str]] = None,
+
+    ) -> List[Dict[str, Any]] :
+    """
+    Attachments (Graph metadata) whose name contains one of the rules, case-insensitive.
+    Without rules every attachment is kept.
+    """
+    attachments = [] if attachments is None else attachments
+
+    if not rules :
+        return list(attachments)
+
+    rules_lc = [r.lower() for r in rules]
+
+    return [a for a in attachments if any(r in (a.get("name") or "").lower() for r in rules_lc)]
+
+
+def attachment_file_name (attachment : Dict[str, Any]) -> str :
+    """
+    Name of the file an attachment (Graph metadata) is saved under in its folder.
+    """
+    return attachment.get("name") or attachment.get("contentType") or f"attachment-{attachment.get('id')}"
+
+
+def file_sha256 (file_abs_path : str, chunk_size : int = 1 << 20) -> str :
+    """
+    Hex sha256 of a file, read by chunks.
+    """
+    h = hashlib.sha256()
+
+    with open(file_abs_path, "rb") as f :
+
+        for chunk in iter(lambda: f.read(chunk_size), b"") :
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+class AttachmentManifest (FileMetadataCache) :
+    """
+    Persisted manifest of the downloaded attachments :
+
+        {"message id/attachment id" : {"path", "name", "size", "file_size", "mtime_ns", "sha256"}}
+
+    `size` is the Graph attachment size (as listed by $expand=attachments), the other
+    fields describe the file written on disk. An attachment is present when its entry
+    exists, Graph still reports the same size and the file on disk is the one written :
+    same size and mtime, or (file touched since) same sha256.
+
+    Files are named after the attachment, so two messages can write the same path (a
+    statement re-sent under the same name). Recording a path marks the other entries of
+    that path "superseded_by" the new key : they stay present, i.e. are not downloaded
+    again, as long as the file is still the one of the entry that replaced them.
+    """
+
+    @staticmethod
+    def _key (message_id : str, attachment_id : str) -> str :
+        return f"{message_id}/{attachment_id}"
+
+
+    def present (
+
+            self,
+            message_id : str,
+            attachment : Dict[str, Any],
+
+        ) -> Optional[str] :
+        """
+        Path of the file already downloaded for this attachment metadata, else None.
+        """
+        with self._lock :
+
+            entries = self._load()
+            entry = entries.get(self._key(message_id, attachment.get("id")))
+
+        if entry is None :
+            return None
+
+        if attachment.get("size") is not None and entry.get("size") != attachment.get("size") :
+            return None
+
+        if entry.get("superseded_by") is not None :
+
+            with self._lock :
+                entry = entries.get(entry["superseded_by"])
+
+            if entry is None :
+                return None
+
+        return self._on_disk(entry)
+
+
+    def _on_disk (self, entry : Dict[str, Any]) -> Optional[str] :
+        """
+        Path of the entry if the file on disk is still the one it recorded, else None.
+        """
+        path = entry.get("path")
+
+        try :
+            st = os.stat(path)
+
+        except (OSError, TypeError) :
+            return None
+
+        if st.st_size != entry.get("file_size") :
+            return None
+
+        if st.st_mtime_ns != entry.get("mtime_ns") :
+
+            if file_sha256(path) != entry.get("sha256") :
+                return None
+
+            with self._lock :
+                entry["mtime_ns"] = st.st_mtime_ns
+
+        return path
+
+
+    def record (
+
+            self,
+            message_id : str,
+            attachment : Dict[str, Any],
+            path : str,
+            flush : bool = True,
+
+        ) -> None :
+        """
+        Register the file written for an attachment.
+        """
+        try :
+
+            st = os.stat(path)
+            digest = file_sha256(path)
+
+        except OSError as e :
+
+            print(f"[-] Failed to register attachment {path}: {e}")
+            return
+
+        key = self._key(message_id, attachment.get("id"))
+        same_path = os.path.normcase(os.path.abspath(path))
+
+        with self._lock :
+
+            entries = self._load()
+
+            # Another attachment written to the same path is replaced by this one
+            for other_key, other in entries.items() :
+
+                if other_key != key and other.get("path") and os.path.normcase(os.path.abspath(other["path"])) == same_path :
+                    other["superseded_by"] = key
+
+            entries[key] = {
+
+                "path" : path,
+                "name" : attachment.get("name"),
+                "size" : attachment.get("size"),
+                "file_size" : st.st_size,
+                "mtime_ns" : st.st_mtime_ns,
+                "sha256" : digest,
+
+            }
+
+            if flush :
+                self._flush()
+
+
+    def flush (self) -> None :
+
+        with self._lock :
+
+            self._load()
+            self._flush()
+
+
+_ATTACHMENT_MANIFEST : Optional[AttachmentManifest] = None
+_ATTACHMENT_MANIFEST_LOCK = threading.Lock()
+
+
+def get_attachment_manifest () -> AttachmentManifest :
+    """
+    Return the process-wide attachment manifest (created on first call).
+    """
+    global _ATTACHMENT_MANIFEST
+
+    with _ATTACHMENT_MANIFEST_LOCK :
+
+        if _ATTACHMENT_MANIFEST is None :
+            _ATTACHMENT_MANIFEST = AttachmentManifest(ATTACHMENT_MANIFEST_FILENAME_ABS)
+
+        return _ATTACHMENT_MANIFEST
+
+
+_ATTACHMENT_INDEX : Optional[AttachmentIndex] = None
+_ATTACHMENT_INDEX_LOCK = threading.Lock()
+
+
+def get_attachment_index () -> AttachmentIndex :
+    """
+    Return the process-wide attachment index (created on first call).
+    """
+    global _ATTACHMENT_INDEX
+
+    with _ATTACHMENT_INDEX_LOCK :
+
+        if _ATTACHMENT_INDEX is None :
+            _ATTACHMENT_INDEX = AttachmentIndex()
+
+        return _ATTACHMENT_INDEX
@@ -69,7 +69,8 @@ EMAIL_COLUMNS = {
     "From" : pl.Utf8,
     "Received DateTime" : pl.Utf8,#pl.Datetime,
     "Attachments" : pl.Boolean,
-    "Shared Email" : pl.Utf8
+    "Shared Email" : pl.Utf8,
+    "Attachments Meta" : pl.Utf8 # JSON list of {id, name, contentType, size, isInline} ($expand)
 
 }
 
@@ -107,6 +108,39 @@ COLLATERAL_COLUMNS = {
 }
 
 
+# Natural keys : identify the figures a restated block replaces in the history (see
+# utils.upsert_history_rows). They are not unique, a statement can hold several rows per key.
+CASH_KEY_COLUMNS = [
+
+    "Fundation",
+    "Account",
+    "Date",
+    "Bank",
+    "Currency",
+    "Type"
+
+]
+
+
+COLLATERAL_KEY_COLUMNS = [
+
+    "Fundation",
+    "Account",
+    "Date",
+    "Bank",
+    "Currency"
+
+]
+
+
+KINDS_KEYS_DICT = {
+
+    "cash" : CASH_KEY_COLUMNS,
+    "collateral" : COLLATERAL_KEY_COLUMNS
+
+}
+
+
 KINDS_COLUMNS_DICT = {
 
     "cash" : CASH_COLUMNS,
@@ -115,6 +149,15 @@ KINDS_COLUMNS_DICT = {
 }
 
 
+FX_CACHE_COLUMNS = {
+
+    "Date" : pl.Date,
+    "Pair" : pl.Utf8,
+    "Close" : pl.Float64
+
+}
+
+
 CACHE_COLUMNS = {
 
     "Date" : pl.Date,
@@ -133,10 +176,31 @@ CACHE_FILE_NAME = os.getenv("CACHE_FILE_NAME")
 
 CACHE_FILENAME_ABS = os.path.join(CACHE_DIR_ABS_PATH, CACHE_FILE_NAME)
 
+# FX rates cache (Date, Pair) -> Close, and optional offline fixture with the same columns
+FX_CACHE_FILE_NAME = os.getenv("FX_CACHE_FILE_NAME", "fx_rates.parquet")
+FX_CACHE_FILENAME_ABS = os.path.join(CACHE_DIR_ABS_PATH, FX_CACHE_FILE_NAME)
+
+FX_FIXTURE_FILENAME_ABS = os.getenv("FX_FIXTURE_FILENAME_ABS")
+
+# Incremental mailbox sync : per (mailbox, day) receivedDateTime watermark + processed message ids
+MAIL_SYNC_FILE_NAME = os.getenv("MAIL_SYNC_FILE_NAME", "mail_sync.json")
+MAIL_SYNC_FILENAME_ABS = os.path.join(CACHE_DIR_ABS_PATH, MAIL_SYNC_FILE_NAME)
+
+# Downloaded attachments : (message id, attachment id) -> {path, size, file_size, mtime_ns, sha256}
+ATTACHMENT_MANIFEST_FILE_NAME = os.getenv("ATTACHMENT_MANIFEST_FILE_NAME", "attachments_manifest.json")
+ATTACHMENT_MANIFEST_FILENAME_ABS = os.path.join(CACHE_DIR_ABS_PATH, ATTACHMENT_MANIFEST_FILE_NAME)
+
 HISTORY_DIR_ABS_PATH= os.getenv("HISTORY_DIR_ABS_PATH")
 ATTACH_DIR_ABS_PATH = os.getenv("ATTACH_DIR_ABS_PATH")
 RAW_DIR_ABS_PATH = os.getenv("RAW_DIR_ABS_PATH")
 
+# Audit dump of the routed inbox rows : parquet | ndjson (one file per counterparty and month),
+# xlsx (one workbook per counterparty and date, slow) or none. See src/raw_dump.py
+RAW_DUMP_FORMAT = os.getenv("RAW_DUMP_FORMAT", "parquet").strip().lower()
+
+# Routing diagnosis : trace columns in the routed rows (and raw dumps) + per-rule counters printed
+ROUTING_EXPLAIN = os.getenv("ROUTING_EXPLAIN", "0").strip().lower() in ("1", "true", "yes")
+
 
 FREQUENCY_DATE_MAP = {
 
@@ -355,6 +419,10 @@ USB_TARGET_FIELDS = {
 
 UBS_ATTACHMENT_DIR_ABS_PATH = os.getenv("UBS_ATTACHMENT_DIR_ABS_PATH")
 
+# Sidecar index of the UBS workbooks (statement date, sheet names), see ubs.get_ubs_file_metadata
+UBS_METADATA_FILE_NAME = os.getenv("UBS_METADATA_FILE_NAME", "ubs_metadata.json")
+UBS_METADATA_FILENAME_ABS = os.path.join(CACHE_DIR_ABS_PATH, UBS_METADATA_FILE_NAME)
+
 UBS_FILENAMES_CASH = os.getenv("UBS_FILENAMES_CASH")
 UBS_FILENAMES_COLLATERAL = os.getenv("UBS_FILENAMES_COLLATERAL")
 
@@ -369,6 +437,23 @@ COUNTERPARTIES = {
 
 }
 
+# Attachment names worth downloading per counterparty (case-insensitive substrings of the
+# attachment name, see attachments.select_attachments). No rule : every attachment is kept.
+ATTACHMENT_NAME_RULES = {
+
+    name : sorted({f for f in (*cp["filenames"], *extra) if f})
+    for name, cp, extra in (
+
+        ("MS", MS, (MS_FILENAMES_CASH, MS_FILENAMES_COLLATERAL)),
+        ("GS", GS, (GS_FILENAMES_CASH, GS_FILENAMES_COLLATERAL)),
+        ("SAXO", SAXO, (SAXO_FILENAMES,)),
+        ("EDB", EDB, ()),
+        ("UBS", UBS, (UBS_FILENAMES_CASH, UBS_FILENAMES_COLLATERAL)),
+
+    )
+
+}
+
 
 # Forex Pairs
 PAIRS = ["EURUSD=X", "EURCHF=X", "EURGBP=X", "EURJPY=X", "EURAUD=X"]
\ No newline at end of file
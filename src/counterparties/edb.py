@@ -12,8 +12,9 @@ from src.config import (
     EDB_COLLAT_TYPE_ALLOWED, EDB_COLLAT_DESC_ALLOWED, EDB_COLLAT_DESC_DICT,
     CASH_COLUMNS, COLLATERAL_COLUMNS
 )
-from src.utils import get_full_name_fundation, date_to_str, convert_forex, cache_update, cache_load_row, str_to_date
+from src.utils import get_full_name_fundation, date_to_str, convert_forex, str_to_date, get_file_cache
 from src.api import call_api_for_pairs
+from src.attachments import get_attachment_index
 
 
 def edb_cash (
@@ -269,18 +270,14 @@ def get_file_by_fund_n_date (
     This function looks for the path file by date and fundation (in the file name)
     """
     date_obj = str_to_date(date)
-    date_format = date_to_str(date, d_format)
 
-    df = cache_load_row(None, "EDB", kind, fundation, date_obj)
+    dir_abs_path = EBD_ATTACHMENT_DIR_ABS_PATH if dir_abs_path is None else dir_abs_path
+    cached = get_file_cache().lookup("EDB", kind, fundation, date_obj, dir_abs_path)
 
-    if df.height > 0 :
+    if cached is not None :
 
         print("\n[+] Data information found in cache...Loading")
-
-        col_data = df.select("Filename").item()
-        return col_data
-
-    dir_abs_path = EBD_ATTACHMENT_DIR_ABS_PATH if dir_abs_path is None else dir_abs_path
+        return cached
 
     full_fundation = get_full_name_fundation(fundation)
     formatted_fund = edb_fundation_name_format(full_fundation, f_format)
@@ -290,12 +287,12 @@ def get_file_by_fund_n_date (
         print(f"\n[-] Fundation not found. Retry with a correct fundation name...")
         return full_fundation
     
-    for entry in os.listdir(dir_abs_path) :
+    for entry in get_attachment_index().lookup(dir_abs_path, date, d_format) :
 
-        if (date_format) in entry and formatted_fund in entry :
+        if formatted_fund in entry :
 
             print(f"\n[+] [EDB] File found for {date} and for {full_fundation} : {entry}")
-            #cache_update(None, date_obj, "EDB", fundation, kind, str(entry))
+            get_file_cache().add(date_obj, "EDB", fundation, kind, str(entry))
 
             return entry
         
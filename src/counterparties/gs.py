@@ -11,7 +11,8 @@ from typing import Optional, Dict, Tuple
 from src.config import *
 from src.parser import *
 from src.api import call_api_for_pairs
-from src.utils import get_full_name_fundation, date_to_str, convert_forex, cache_update, cache_load_row, str_to_date, load_cache
+from src.utils import get_full_name_fundation, date_to_str, convert_forex, str_to_date, get_file_cache
+from src.attachments import get_attachment_index
 
 
 def gs_cash (
@@ -245,30 +246,26 @@ def get_file_by_fund_n_date (
     This function looks for the path file by date and fundation (in the file name)
     """
     date_obj = str_to_date(date)
-    date_format = date_to_str(date, d_format)
 
-    df_cache = load_cache()
-    df = cache_load_row(df_cache, "GS", kind, fundation, date_obj)
-
-    if  df.height > 0 :
+    dir_abs_path = GS_ATTACHMENT_DIR_ABS_PATH if dir_abs_path is None else dir_abs_path
+    cached = get_file_cache().lookup("GS", kind, fundation, date_obj, dir_abs_path)
 
-        col_data = df.select("Filename").item()
-        return col_data
+    if cached is not None :
+        return cached
         
-    dir_abs_path = GS_ATTACHMENT_DIR_ABS_PATH if dir_abs_path is None else dir_abs_path
     rules = GS_FILENAMES_CASH if rules is None else rules
 
     full_fundation = get_full_name_fundation(fundation).upper()
     fund_words = [w for w in full_fundation.split() if w]
 
-    for entry in os.listdir(dir_abs_path) :
+    for entry in get_attachment_index().lookup(dir_abs_path, date, d_format) :
 
-        if date_format in entry and entry.startswith(rules) and fund_words[0] in entry :
+        if entry.startswith(rules) and fund_words[0] in entry :
 
             if entry.lower().endswith(extensions) : 
 
                 print(f"\n[+] [GS] File found for {date} and for {full_fundation.lower()} : {entry}")
-                #cache_update(df_cache, date_obj, "GS", fundation, kind, entry)
+                get_file_cache().add(date_obj, "GS", fundation, kind, entry)
 
                 return entry
         
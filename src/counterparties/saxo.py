@@ -7,8 +7,9 @@ import datetime as dt
 from typing import Optional, Dict, List
 
 from src.config import *
-from src.utils import get_full_name_fundation, date_to_str, convert_forex, cache_update, str_to_date, cache_load_row, load_cache
+from src.utils import get_full_name_fundation, date_to_str, convert_forex, str_to_date, get_file_cache
 from src.api import call_api_for_pairs
+from src.attachments import get_attachment_index
 
 
 def saxo_cash (
@@ -221,27 +222,23 @@ def get_file_by_fund_n_date (
     This function looks for the path file by date and fundation (in the file name)
     """
     date_obj = str_to_date(date)
-    date_format = date_to_str(date, d_format)
 
-    df_cache = load_cache()
-    df = cache_load_row(df_cache, "SAXO", kind, fundation, date_obj)
-
-    if df.height > 0 :
+    dir_abs_path = SAXO_ATTACHMENT_DIR_ABS_PATH if dir_abs_path is None else dir_abs_path
+    cached = get_file_cache().lookup("SAXO", kind, fundation, date_obj, dir_abs_path)
 
-        col_data = df.select("Filename").item()
-        return col_data
+    if cached is not None :
+        return cached
 
     rules = SAXO_FILENAMES if rules is None else rules
-    dir_abs_path = SAXO_ATTACHMENT_DIR_ABS_PATH if dir_abs_path is None else dir_abs_path
 
     full_fundation = get_full_name_fundation(fundation)
 
-    for entry in os.listdir(dir_abs_path) :
+    for entry in get_attachment_index().lookup(dir_abs_path, date, d_format) :
 
-        if date_format in entry and rules in entry :
+        if rules in entry :
 
             print(f"\n[+] [SAXO] File found for {date} and for {full_fundation}")
-            #cache_update(df_cache, date_obj, "SAXO", fundation, kind, entry)
+            get_file_cache().add(date_obj, "SAXO", fundation, kind, entry)
             
             return entry
         
@@ -1,18 +1,21 @@
 from __future__ import annotations
 
 import os
+import re
 import warnings
+import threading
 import polars as pl
 import pandas as pd
 import datetime as dt
 
 from python_calamine import CalamineWorkbook
 from openpyxl import load_workbook
-from typing import Dict, Optional, Tuple
+from typing import Dict, Optional, Tuple, List
 
 from src.config import *
 from src.utils import date_to_str, convert_forex
 from src.api import call_api_for_pairs
+from src.attachments import get_attachment_index, FileMetadataCache, FORMAT_TOKENS, format_to_regex
 
 
 def ubs_cash (
@@ -235,27 +238,20 @@ def get_file_by_fund_n_date_cash (
     """
     This function looks for the path file by date and fundation (in the file name)
     """
+    day = date_to_str(date)
     date = date_to_str(date, d_format)
 
     rules = UBS_FILENAMES_CASH if rules is None else rules
     dir_abs_path = UBS_ATTACHMENT_DIR_ABS_PATH if dir_abs_path is None else dir_abs_path
 
     full_fundation = get_full_name_fundation(fundation)
+    entries = ubs_entries_by_date(dir_abs_path, rules, "cash", d_format, extensions).get(day)
 
-    for entry in os.listdir(dir_abs_path) :
+    if entries :
 
-        if entry.lower().endswith(extensions) and rules in entry :
+        print(f"\n[+] File found for {date} and for {full_fundation} : {entries[0]}")
+        return entries[0]
 
-            full_path = os.path.join(dir_abs_path, entry)
-            
-            out = pl.read_excel(full_path, engine="calamine")
-
-            #if date in entry and rules in entry :
-            if get_date_from_file_df(out, date) :
-
-                print(f"\n[+] File found for {date} and for {full_fundation} : {entry}")
-                return entry
-            
     return None
 
 
@@ -281,46 +277,202 @@ def get_file_by_fund_n_date_collat (
     dir_abs_path = UBS_ATTACHMENT_DIR_ABS_PATH if dir_abs_path is None else dir_abs_path
 
     full_fundation = get_full_name_fundation(fundation)
+    entries = ubs_entries_by_date(dir_abs_path, rules, "collateral", d_format, extensions).get(date)
 
-    for entry in os.listdir(dir_abs_path) :
+    if entries :
 
-        if entry.lower().endswith(extensions) and rules in entry :
+        print(f"\n[+] [UBS] File found for {date} and for {full_fundation} : {entries[0]}")
+        return entries[0]
 
-            full_path = os.path.join(dir_abs_path, entry)
-            
-            wb = CalamineWorkbook.from_path(full_path)
-            sheet_name = wb.sheet_names[0]
-            
-            if sheet_name.endswith(date) :
+    return None
 
-                print(f"\n[+] [UBS] File found for {date} and for {full_fundation} : {entry}")
-                return entry
 
-    return None
+_UBS_METADATA : Optional[FileMetadataCache] = None
+_UBS_METADATA_LOCK = threading.Lock()
 
 
-def get_date_from_file_df (
+def read_ubs_file_metadata (file_abs_path : str, n_values : int = 2) -> Dict :
+    """
+    Open a UBS workbook once and keep what discovery needs :
+      - sheet_names (the collateral statement date is the end of the first one)
+      - head_values : first values of the first column under the header (cash statement date)
+    """
+    wb = CalamineWorkbook.from_path(file_abs_path)
+    sheet_names = list(wb.sheet_names)
+
+    rows = wb.get_sheet_by_index(0).to_python() if sheet_names else []
+    head_values = []
+
+    # Same rows as pl.read_excel : the first row is the header, empty rows are dropped
+    for row in rows[1:] :
+
+        if all(c is None or str(c).strip() == "" for c in row) :
+            continue
+
+        head_values.append(None if row[0] is None or row[0] == "" else str(row[0]))
+
+        if len(head_values) >= n_values :
+            break
+
+    return {"sheet_names" : sheet_names, "head_values" : head_values}
+
+
+def get_ubs_metadata_cache () -> FileMetadataCache :
+    """
+    Return the process-wide UBS metadata sidecar (created on first call).
+    """
+    global _UBS_METADATA
+
+    with _UBS_METADATA_LOCK :
+
+        if _UBS_METADATA is None :
+            _UBS_METADATA = FileMetadataCache(UBS_METADATA_FILENAME_ABS)
+
+        return _UBS_METADATA
+
+
+def get_ubs_file_metadata (file_abs_path : str) -> Optional[Dict] :
+    """
+    Metadata of a UBS workbook from the persisted sidecar, the file is only opened
+    the first time it is seen (or after it changed).
+    """
+    return get_ubs_metadata_cache().get(file_abs_path, read_ubs_file_metadata)
+
+
+# (dir, rules, kind, d_format) -> (dir mtime_ns, {date : entries in listdir order})
+_UBS_DATE_MAPS : Dict[Tuple[str, Optional[str], str, str], Tuple[int, Dict[str, List[str]]]] = {}
+_UBS_DATE_MAPS_LOCK = threading.Lock()
+
+
+def ubs_entries_by_date (
+
+        dir_abs_path : str,
+        rules : Optional[str] = None,
+        kind : str = "cash",
+        d_format : str = "%b %d, %Y",
+        extensions : Tuple[str, str] = (".xls", ".xlsx")
+
+    ) -> Dict[str, List[str]] :
+    """
+    {date : entries} of the UBS workbooks of a directory, built from the metadata sidecar
+    once per directory mtime (as AttachmentIndex._by_date), so discovery is a dict access.
+
+    cash       : keyed by the statement date (YYYY-MM-DD) starting the first column values,
+                 written with d_format (day with or without zero padding)
+    collateral : keyed by the date (d_format) ending the first sheet name
+    """
+    try :
+        mtime = os.stat(dir_abs_path).st_mtime_ns
+
+    except OSError :
+        return {}
+
+    key = (os.path.normcase(os.path.abspath(dir_abs_path)), rules, kind, d_format)
+
+    with _UBS_DATE_MAPS_LOCK :
+
+        cached = _UBS_DATE_MAPS.get(key)
+
+        if cached is not None and cached[0] == mtime :
+            return cached[1]
+
+        by_date : Dict[str, List[str]] = {}
+
+        for entry in get_attachment_index().entries(dir_abs_path) :
+
+            if not (entry.lower().endswith(extensions) and rules in entry) :
+                continue
+
+            meta = get_ubs_file_metadata(os.path.join(dir_abs_path, entry)) or {}
+
+            if kind == "cash" :
+                dates = _statement_dates(meta.get("head_values", []), d_format)
+
+            else :
+                dates = _sheet_dates(meta.get("sheet_names", []), d_format)
+
+            for d in dates :
+                by_date.setdefault(d, []).append(entry)
+
+        _UBS_DATE_MAPS[key] = (mtime, by_date)
+
+        return by_date
+
+
+def _statement_dates (values : List[Optional[str]], d_format : str = "%b %d, %Y") -> List[str] :
+    """
+    YYYY-MM-DD of the values starting with a date written with d_format (e.g. "Nov 3, 2025 ...").
+    """
+    tokens = {**FORMAT_TOKENS, "%d" : r"\d{1,2}", "%m" : r"\d{1,2}"}
+    parts = re.split(r"(%[A-Za-z])", d_format)
+    pattern = re.compile("".join(tokens.get(p, re.escape(p)) if p.startswith("%") else re.escape(p) for p in parts if p))
+
+    dates = []
+
+    for value in values :
+
+        m = pattern.match(value) if value is not None else None
+
+        if m is None :
+            continue
+
+        try :
+            dates.append(date_to_str(dt.datetime.strptime(m.group(0), d_format)))
+
+        except ValueError :
+            continue
+
+    return dates
+
+
+def _sheet_dates (sheet_names : List[str], d_format : str = "%Y%m%d") -> List[str] :
+    """
+    Dates (written with d_format) ending the first sheet name.
+    """
+    if not sheet_names :
+        return []
+
+    name = sheet_names[0]
+
+    return [m.group(1) for m in format_to_regex(d_format).finditer(name) if name.endswith(m.group(1))]
+
+
+def get_date_from_values (
         
-        df : pl.DataFrame,
+        values : list,
         date : Optional[str | dt.datetime | dt.date] = None,
         format : str = "%b %d, %Y",
 
-    ) :
+    ) -> bool :
+    """
+    True if one of the values starts with the date (e.g. "Nov 3, 2025 ...")
+    """
     date = date_to_str(date, format)
     date_formatted = date.replace(" 0", " ")
-    colname = df.columns[0]
-
-    # Get first 2 values from first column
-    values = df[colname].head(2).to_list()
 
     for value in values :
         
-        if value.startswith(date_formatted) :
+        if value is not None and value.startswith(date_formatted) :
             return True
         
     return False
 
 
+def get_date_from_file_df (
+        
+        df : pl.DataFrame,
+        date : Optional[str | dt.datetime | dt.date] = None,
+        format : str = "%b %d, %Y",
+
+    ) :
+    colname = df.columns[0]
+
+    # Get first 2 values from first column
+    values = df[colname].head(2).cast(pl.Utf8).to_list()
+
+    return get_date_from_values(values, date, format)
+
+
 def get_df_from_file_cash (
         
         file_abs_path : Optional[str] = None,
@@ -3,6 +3,8 @@ from __future__ import annotations
 import re
 import polars as pl
 
+from functools import lru_cache
+
 from src.config import COUNTERPARTIES
 from typing import Dict, List, Optional, Set, Tuple, Iterable
 
@@ -57,16 +59,66 @@ def _normalize_rules(rules: Optional[Dict[str, Dict]]) -> Dict[str, Dict]:
         subj_pat = _compile_subject_pattern(rule.get("subject", []))
         filenames = {str(f).strip().lower() for f in rule.get("filenames", set()) if str(f).strip()}
 
+        # Sorted once here, these lists are what is_in consumes
         out[name] = {
-            "emails": emails,
-            "domains": domains,
+            "emails": sorted(emails),
+            "domains": sorted(domains),
             "subject_re": subj_pat,
-            "filenames": filenames,
+            "filenames": sorted(filenames),
         }
 
     return out
 
 
+# -------------------- Compiled rules (memoized) --------------------
+
+def _rules_fingerprint(rules: Optional[Dict[str, Dict]]) -> Tuple:
+    """
+    Hashable snapshot of a rules dict: counterparty order kept, field values canonicalized
+    (strings as is, collections sorted), so equal contents give equal fingerprints.
+    """
+    def canon(value):
+        if value is None or isinstance(value, str):
+            return value
+        if isinstance(value, (set, frozenset, list, tuple)):
+            return tuple(sorted(str(v) for v in value))
+        return str(value)
+
+    return tuple(
+        (name, tuple((key, canon(value)) for key, value in sorted(rule.items())))
+        for name, rule in (rules or {}).items()
+    )
+
+
+class CompiledRules :
+    """
+    Routing rules ready for split_by_counterparty: normalized rules (sorted lists), the
+    assignment expressions of the when-chain, the rule names and the (name, score) branches.
+    Built once per rules content, see compile_rules.
+    """
+
+    def __init__ (self, rules: Optional[Dict[str, Dict]]) -> None :
+
+        self.rules = _normalize_rules(rules)
+        self.names = list(self.rules.keys())
+        self.exprs, self.branches = _compile_rules(self.rules)
+
+
+@lru_cache(maxsize=16)
+def _compile_rules_cached(fingerprint: Tuple) -> CompiledRules:
+    rules = {name: dict(items) for name, items in fingerprint}
+    return CompiledRules(rules)
+
+
+def compile_rules(rules: Optional[Dict[str, Dict]] = None) -> CompiledRules:
+    """
+    Compiled routing rules, memoized on the rules content (COUNTERPARTIES by default):
+    the sets, regexes and expressions are built on the first call only.
+    """
+    rules = COUNTERPARTIES if rules is None else rules
+    return _compile_rules_cached(_rules_fingerprint(rules))
+
+
 # -------------------- DataFrame preparation --------------------
 
 def _extract_sender_columns(df: pl.DataFrame) -> pl.DataFrame:
@@ -103,57 +155,51 @@ def _extract_sender_columns(df: pl.DataFrame) -> pl.DataFrame:
     return out
 
 
-def _normalize_attachments(df: pl.DataFrame, attachment_column: Optional[str]) -> pl.DataFrame :
+def _columns(frame: pl.DataFrame | pl.LazyFrame) -> List[str]:
+    """
+    Column names of an eager or lazy frame (schema only, nothing is computed).
+    """
+    return frame.collect_schema().names()
+
+
+def _normalize_attachments(df: pl.DataFrame | pl.LazyFrame, attachment_column: Optional[str]) -> pl.DataFrame | pl.LazyFrame :
     """
     Create _files as a lowercased list[str] (empty if none).
     Works whether the column is already a list or a single string filename.
     """
-    if attachment_column and attachment_column in df.columns :
+    if attachment_column and attachment_column in _columns(df) :
 
         col = pl.col(attachment_column)
+
+        # Dispatch on the column dtype (known from the schema, also for a LazyFrame).
+        # Native expressions only (no Python UDF); the names are lowercased here, once.
+        if isinstance(df.collect_schema()[attachment_column], pl.List) :
+            files = col.cast(pl.List(pl.Utf8)).list.eval(pl.element().str.to_lowercase())
+
+        else :
+            files = pl.concat_list([col.cast(pl.Utf8).str.to_lowercase()])
         
         return df.with_columns(
             
             pl.when(col.is_null())
-                .then(pl.lit([]))
-                .when(col.is_list())
-                .then(
-
-                    col.cast(pl.List(pl.Utf8)).list.eval(pl.element().cast(pl.Utf8).str.to_lowercase())
-                )
-                .otherwise(
-                    
-                    col.cast(pl.Utf8).str.to_lowercase().map_elements(lambda s: [s], return_dtype=pl.List(pl.Utf8))
-                
-                )
+                .then(pl.lit([], dtype=pl.List(pl.Utf8)))
+                .otherwise(files)
                 .alias("_files")
             )
     
-    return df.with_columns(pl.lit([]).alias("_files"))
-
-
-def _init_assignment (df: pl.DataFrame) -> pl.DataFrame :
-    """
-    Add assignment columns: _assigned, _score.
-    """
-    return df.with_columns(
-        
-        pl.lit("UNMATCHED").alias("_assigned"),
-        pl.lit(-1).alias("_score"),
-    
-    )
+    return df.with_columns(pl.lit([], dtype=pl.List(pl.Utf8)).alias("_files"))
 
 
-def _filter_attachments_only (df: pl.DataFrame, column : str = "Attachments") -> pl.DataFrame :
+def _filter_attachments_only (df: pl.DataFrame | pl.LazyFrame, column : str = "Attachments") -> pl.DataFrame | pl.LazyFrame :
     """
     Keep rows where hasAttachments == True.
     - If 'hasAttachments' is missing, return empty (strict policy).
     - Accepts booleans or strings like 'true'/'1'/'yes'.
     """
-    if df.is_empty() :
+    if isinstance(df, pl.DataFrame) and df.is_empty() :
         return df
 
-    if column not in df.columns :
+    if column not in _columns(df) :
         return df.clear()
 
     cond = pl.coalesce(
@@ -168,110 +214,287 @@ def _filter_attachments_only (df: pl.DataFrame, column : str = "Attachments") ->
 
 # -------------------- Assignment (email/domain AND subject) --------------------
 
-def _assign_by_emails (
+def _subject_enabled (subject_re: str) -> bool :
+    return bool(subject_re) and subject_re not in (r"^(?!)", r"(?!)")
+
+
+def _subject_hit (subject_re: str) -> pl.Expr :
+    """
+    Subject contains the rule pattern.
+    """
+    return pl.col("_subject").str.contains(subject_re, literal=False, strict=False)
+
+
+def _files_ok (filenames: List[str]) -> pl.Expr :
+    """
+    At least one filename matches, required ONLY when the row has filenames.
+    """
+    files_len = pl.col("_files").list.len()
+    # _files is already lowercased (see _normalize_attachments)
+    fn_any = pl.col("_files").list.eval(pl.element().is_in(filenames)).list.any()
+    return pl.when(files_len > 0).then(fn_any).otherwise(pl.lit(True))
+
+
+def _match_condition (
         
-        df: pl.DataFrame,
-        name: str,
-        emails: Set[str],
+        column: str,
+        values: List[str],
         subject_re: str,
-        filenames: Set[str],
+        filenames: List[str],
     
-    ) -> pl.DataFrame :
+    ) -> Optional[pl.Expr] :
     """
-    Assign when sender email matches AND subject contains the configured pattern.
+    Condition "`column` (sender email or domain) in values AND subject contains the pattern".
     If 'filenames' provided, require at least one filename match ONLY when the row has filenames.
+    None when the rule cannot match (no values or no subject pattern).
     """
-    if not emails or not subject_re or subject_re in (r"^(?!)", r"(?!)") :
-        return df
+    if not values or not _subject_enabled(subject_re) :
+        return None
 
-    subj_hit = pl.col("_subject").str.contains(subject_re, literal=False, strict=False)
-    base = (pl.col("_assigned") == "UNMATCHED") & pl.col("_sender_email").is_in(sorted(emails)) & subj_hit
+    base = pl.col(column).is_in(values) & _subject_hit(subject_re)
 
     if filenames:
-        files_len = pl.col("_files").list.len()
-        fn_any = pl.col("_files").list.eval(
-            pl.element().cast(pl.Utf8).str.to_lowercase().is_in(sorted(filenames))
-        ).list.any()
-        cond = base & pl.when(files_len > 0).then(fn_any).otherwise(pl.lit(True))
-    else:
-        cond = base
+        return base & _files_ok(filenames)
 
-    return df.with_columns(
-        pl.when(cond).then(pl.lit(name)).otherwise(pl.col("_assigned")).alias("_assigned"),
-        pl.when(cond).then(pl.lit(100)).otherwise(pl.col("_score")).alias("_score"),
-    )
+    return base
 
 
-def _assign_by_domains(
-        
-        df: pl.DataFrame,
-        name: str,
-        domains: Set[str],
-        subject_re: str,
-        filenames: Set[str],
+def _compile_rules (nrules: Dict[str, Dict]) -> Tuple[List[pl.Expr], List[Tuple[str, int]]] :
+    """
+    Compile the normalized rules into one pl.when chain evaluated in a single pass.
 
-    ) -> pl.DataFrame:
+    Branch order is the assignment priority: cp1 email (100), cp1 domain (80), cp2 email, ...
+    i.e. the first counterparty whose email or domain rule matches wins, as when the rules
+    were applied one after the other on the still UNMATCHED rows.
+
+    Returns the expressions adding _assigned/_score, and the (name, score) of each branch.
     """
-    Assign when sender domain matches AND subject contains the configured pattern.
-    If 'filenames' provided, require at least one filename match ONLY when the row has filenames.
+    branches: List[Tuple[pl.Expr, str, int]] = []
+
+    for name, rule in nrules.items():
+        for column, values, score in (("_sender_email", rule["emails"], 100), ("_sender_domain", rule["domains"], 80)):
+            cond = _match_condition(column, values, rule["subject_re"], rule["filenames"])
+            if cond is not None:
+                branches.append((cond, name, score))
+
+    if not branches:
+        return [pl.lit("UNMATCHED").alias("_assigned"), pl.lit(-1).alias("_score")], []
+
+    chain = pl.when(branches[0][0]).then(pl.lit(0))
+    for i, (cond, _, _) in enumerate(branches[1:], start=1):
+        chain = chain.when(cond).then(pl.lit(i))
+
+    idx = chain.otherwise(pl.lit(None)).cast(pl.Int32)
+    names = [name for _, name, _ in branches]
+    scores = [score for _, _, score in branches]
+    positions = list(range(len(branches)))
+
+    exprs = [
+        idx.replace_strict(positions, names, default="UNMATCHED", return_dtype=pl.Utf8).alias("_assigned"),
+        idx.replace_strict(positions, scores, default=-1, return_dtype=pl.Int32).alias("_score"),
+    ]
+
+    return exprs, [(name, score) for _, name, score in branches]
+
+
+# -------------------- Explain / trace --------------------
+
+_CHECKS = ("email", "domain", "subject", "files")
+
+
+def _check_column (name: str, check: str) -> str :
+    return f"_chk_{name}_{check}"
+
+
+def _explain_exprs (compiled: "CompiledRules") -> Tuple[List[pl.Expr], List[pl.Expr]] :
     """
-    if not domains or not subject_re or subject_re in (r"^(?!)", r"(?!)"):
-        return df
+    Vectorized routing trace, two with_columns steps:
+      1. one boolean column per (rule, check): sender email in the rule emails, sender
+         domain in the rule domains, subject hit, filenames ok
+      2. Routing Rule / Routing Score / Routing Via (email|domain) and a per-message
+         Routing Trace string, e.g. "MS(email=1 domain=1 subject=0 files=1); GS(...)"
+    A disabled part of a rule (no emails, no subject pattern) reads 0.
+    """
+    checks: List[pl.Expr] = []
+    parts: List[pl.Expr] = []
+
+    for name, rule in compiled.rules.items():
+        exprs = {
+            "email": pl.col("_sender_email").is_in(rule["emails"]) if rule["emails"] else pl.lit(False),
+            "domain": pl.col("_sender_domain").is_in(rule["domains"]) if rule["domains"] else pl.lit(False),
+            "subject": _subject_hit(rule["subject_re"]) if _subject_enabled(rule["subject_re"]) else pl.lit(False),
+            "files": _files_ok(rule["filenames"]) if rule["filenames"] else pl.lit(True),
+        }
 
-    subj_hit = pl.col("_subject").str.contains(subject_re, literal=False, strict=False)
-    base = (pl.col("_assigned") == "UNMATCHED") & pl.col("_sender_domain").is_in(sorted(domains)) & subj_hit
+        checks.extend(exprs[c].fill_null(False).alias(_check_column(name, c)) for c in _CHECKS)
 
-    if filenames:
-        files_len = pl.col("_files").list.len()
-        fn_any = pl.col("_files").list.eval(
-            pl.element().cast(pl.Utf8).str.to_lowercase().is_in(sorted(filenames))
-        ).list.any()
-        cond = base & pl.when(files_len > 0).then(fn_any).otherwise(pl.lit(True))
-    else:
-        cond = base
+        pieces: List[pl.Expr] = [pl.lit(f"{name}(")]
+        for i, c in enumerate(_CHECKS):
+            pieces.append(pl.lit(("" if i == 0 else " ") + f"{c}="))
+            pieces.append(pl.col(_check_column(name, c)).cast(pl.Int8).cast(pl.Utf8))
+        pieces.append(pl.lit(")"))
 
-    return df.with_columns(
-        pl.when(cond).then(pl.lit(name)).otherwise(pl.col("_assigned")).alias("_assigned"),
-        pl.when(cond).then(pl.lit(80)).otherwise(pl.col("_score")).alias("_score"),
-    )
+        parts.append(pl.concat_str(pieces))
 
+    trace = [
+        pl.col("_assigned").alias("Routing Rule"),
+        pl.col("_score").alias("Routing Score"),
+        pl.when(pl.col("_score") == 100).then(pl.lit("email"))
+          .when(pl.col("_score") == 80).then(pl.lit("domain"))
+          .otherwise(pl.lit(None, dtype=pl.Utf8))
+          .alias("Routing Via"),
+        (pl.concat_str(parts, separator="; ") if parts else pl.lit("")).alias("Routing Trace"),
+    ]
 
-def _apply_rule (df: pl.DataFrame, name: str, rule: Dict) -> pl.DataFrame :
+    return checks, trace
+
+
+def _routing_counters (routed: pl.DataFrame, compiled: "CompiledRules") -> pl.DataFrame :
     """
-    Require subject containment for both email- and domain-based assignment.
+    Per-rule hit counters from the check columns, in one select:
+      Email/Domain/Subject Hits, Files OK, Matched (messages assigned to the rule) and
+      Near Misses (sender recognized by the rule but the message did not end up there).
     """
-    df = _assign_by_emails(df, name, rule["emails"], rule["subject_re"], rule["filenames"])
-    df = _assign_by_domains(df, name, rule["domains"], rule["subject_re"], rule["filenames"])
-    return df
+    names = compiled.names
+    columns = {
+        "Rule": pl.Utf8, "Email Hits": pl.UInt32, "Domain Hits": pl.UInt32, "Subject Hits": pl.UInt32,
+        "Files OK": pl.UInt32, "Matched": pl.UInt32, "Near Misses": pl.UInt32,
+    }
+
+    if not names or routed.is_empty():
+        return pl.DataFrame([(n, 0, 0, 0, 0, 0, 0) for n in names], schema=columns, orient="row")
+
+    exprs: List[pl.Expr] = []
+
+    for name in names:
+        sender = pl.col(_check_column(name, "email")) | pl.col(_check_column(name, "domain"))
+        assigned = pl.col("_assigned") == name
+
+        exprs.extend([
+            pl.col(_check_column(name, "email")).sum().alias(f"{name}|Email Hits"),
+            pl.col(_check_column(name, "domain")).sum().alias(f"{name}|Domain Hits"),
+            pl.col(_check_column(name, "subject")).sum().alias(f"{name}|Subject Hits"),
+            pl.col(_check_column(name, "files")).sum().alias(f"{name}|Files OK"),
+            assigned.sum().alias(f"{name}|Matched"),
+            (sender & ~assigned).sum().alias(f"{name}|Near Misses"),
+        ])
+
+    totals = routed.select(exprs).row(0, named=True)
+    metrics = list(columns.keys())[1:]
+
+    return pl.DataFrame(
+        [[name] + [totals[f"{name}|{m}"] for m in metrics] for name in names],
+        schema=columns,
+        orient="row",
+    )
 
 
 # -------------------- Output buckets --------------------
 
-def _materialize_buckets (dfw: pl.DataFrame, original: pl.DataFrame, names: List[str]) -> Dict[str, pl.DataFrame]:
+_HELPER_COLUMNS = ["_rid", "_from_lc", "_sender_email", "_sender_domain", "_subject", "_files", "_score"]
+
+
+def _materialize_buckets (dfw: pl.DataFrame, original_columns: List[str], names: List[str]) -> Dict[str, pl.DataFrame]:
     """
-    Build the output dict of matched buckets + UNMATCHED.
+    Build the output dict of matched buckets + UNMATCHED with one partition_by pass.
+    Every rule name is present (empty frame when nothing matched).
     Keep original column order, append any new columns at the end (helpers dropped).
     """
-    drops = ["_rid", "_from_lc", "_sender_email", "_sender_domain", "_subject", "_files", "_assigned", "_score"]
+    part_all = dfw.drop(_HELPER_COLUMNS, strict=False)
+    columns = (
+        [c for c in original_columns if c in part_all.columns]
+        + [c for c in part_all.columns if c not in original_columns and c != "_assigned"]
+    )
+
+    parts = part_all.partition_by("_assigned", as_dict=True, maintain_order=True)
+    empty = part_all.select(columns).clear()
+
     out: Dict[str, pl.DataFrame] = {}
 
-    for name in names + ["UNMATCHED"]:
-        part = dfw.filter(pl.col("_assigned") == name).drop(drops, strict=False)
-        out[name] = part.select(
-            [c for c in original.columns if c in part.columns]
-            + [c for c in part.columns if c not in original.columns]
-        )
+    for key, part in parts.items():
+        name = key[0] if isinstance(key, tuple) else key
+        out[name] = part.select(columns)
 
-    return out
+    return {name: out.get(name, empty) for name in names + ["UNMATCHED"]}
+
+
+def _collect_streaming(lf: pl.LazyFrame) -> pl.DataFrame:
+    """
+    Collect with the streaming engine (batches, flat memory), whatever the Polars version.
+    """
+    try:
+        return lf.collect(engine="streaming")
+    except TypeError:
+        # Polars < 1.0 has no `engine` argument
+        return lf.collect(streaming=True)
 
 
 # -------------------- Public API --------------------
 
+def route_by_counterparty_lazy (
+        
+        lf: pl.LazyFrame,
+        rules: Optional[Dict[str, Dict]] = None,
+        attachment_column: Optional[str] = None,
+        explain: bool = False,
+    
+    ) -> pl.LazyFrame :
+    """
+    Lazy routing plan: rows with attachments only, plus the `_assigned` counterparty
+    (or UNMATCHED) and its `_score`. Helper columns are dropped inside the plan, so
+    Polars fuses every step into one projection and nothing intermediate is materialized.
+
+    explain: also add the trace columns (Routing Rule/Score/Via/Trace) and the per-rule
+    `_chk_*` check columns used by the counters (see explain_routing).
+    """
+    compiled = compile_rules(rules)
+
+    plan = _filter_attachments_only(lf)
+    plan = _extract_sender_columns(plan)
+    plan = _normalize_attachments(plan, attachment_column)
+    plan = plan.with_columns(compiled.exprs)
+
+    if explain:
+        checks, trace = _explain_exprs(compiled)
+        plan = plan.with_columns(checks).with_columns(trace)
+
+    return plan.drop([c for c in _HELPER_COLUMNS if c != "_score"])
+
+
+def explain_routing (
+        
+        df: pl.DataFrame | pl.LazyFrame,
+        rules: Optional[Dict[str, Dict]] = None,
+        attachment_column: Optional[str] = None,
+        streaming: bool = True,
+    
+    ) -> Tuple[pl.DataFrame, pl.DataFrame] :
+    """
+    Diagnose the routing without splitting:
+      - trace: every message with attachments, its original columns plus Routing Rule,
+        Routing Score, Routing Via and Routing Trace (which check of which rule passed)
+      - counters: per-rule hit counters (see _routing_counters)
+    e.g. trace.filter(pl.col("Routing Rule") == "UNMATCHED") shows why statements were missed.
+    """
+    compiled = compile_rules(rules)
+    original_columns = _columns(df)
+
+    plan = route_by_counterparty_lazy(df.lazy(), rules, attachment_column, explain=True)
+    routed = _collect_streaming(plan) if streaming else plan.collect()
+
+    counters = _routing_counters(routed, compiled)
+    trace = routed.select(original_columns + ["Routing Rule", "Routing Score", "Routing Via", "Routing Trace"])
+
+    return trace, counters
+
+
 def split_by_counterparty (
         
-        df: pl.DataFrame,
+        df: pl.DataFrame | pl.LazyFrame,
         rules: Optional[Dict[str, Dict]] = None,
         attachment_column: Optional[str] = None,
+        streaming: bool = True,
+        explain: bool = False,
     
     ) -> Dict[str, pl.DataFrame] :
     """
@@ -282,27 +505,36 @@ def split_by_counterparty (
       (1) exact email  (score=100)  AND subject contains pattern (+ optional filenames)
       (2) domain       (score=80)   AND subject contains pattern (+ optional filenames)
 
+    `df` may be a LazyFrame (e.g. pl.scan_parquet of a quarter of raw dumps): the routing
+    runs as one lazy plan (route_by_counterparty_lazy), collected with the streaming engine
+    unless streaming=False.
+
+    explain: every bucket also carries the Routing Rule/Score/Via/Trace columns and the
+    per-rule hit counters are printed (see explain_routing). Off by default, the default
+    path computes none of it.
+
     Returns a dict with matched buckets + an "UNMATCHED" bucket.
     """
     rules = COUNTERPARTIES if rules is None else rules
 
-    if df is None or df.is_empty() :
+    if df is None or (isinstance(df, pl.DataFrame) and df.is_empty()) :
         return {}
 
-    # Strict: attachments only
-    df2 = _filter_attachments_only(df)
+    original_columns = _columns(df)
+    compiled = compile_rules(rules)
 
-    if df2.is_empty() :
-        # Nothing to classify; still return a single UNMATCHED bucket for consistency
-        return {"UNMATCHED": df2}
+    plan = route_by_counterparty_lazy(df.lazy(), rules, attachment_column, explain=explain)
+    routed = _collect_streaming(plan) if streaming else plan.collect()
+
+    if explain :
 
-    nrules = _normalize_rules(rules)
+        print("\n[*] Routing counters :")
+        print(_routing_counters(routed, compiled))
 
-    work = _extract_sender_columns(df2)
-    work = _normalize_attachments(work, attachment_column)
-    work = _init_assignment(work)
+        routed = routed.drop([c for c in routed.columns if c.startswith("_chk_")])
 
-    for name, rule in nrules.items() :
-        work = _apply_rule(work, name, rule)
+    if routed.is_empty() :
+        # Nothing to classify; still return a single UNMATCHED bucket for consistency
+        return {"UNMATCHED": routed.select(original_columns)}
 
-    return _materialize_buckets(work, df2, list(nrules.keys()))
+    return _materialize_buckets(routed, original_columns, compiled.names)
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import os
+import math
+import threading
+import datetime as dt
+import polars as pl
+
+from collections import OrderedDict
+from typing import Optional, Dict, List
+
+from src.config import FX_CACHE_FILENAME_ABS, FX_FIXTURE_FILENAME_ABS, FX_CACHE_COLUMNS
+from src.utils import str_to_date, write_atomic
+
+
+class FxCache :
+    """
+    FX close values keyed by (date, pair), e.g. ("2025-11-12", "EURUSD=X") -> 1.158
+
+    Two levels :
+      - an in-memory LRU of the most recent dates
+      - a parquet file on disk, loaded once, so a past date is downloaded at most once ever
+
+    When a fixture file is given the cache is read-only and offline : it is served
+    from the fixture and never asks for a download (used to run the pipeline without network).
+    """
+
+    def __init__ (
+
+            self,
+            filename : Optional[str] = None,
+            fixture : Optional[str] = None,
+            max_dates : int = 512,
+
+        ) -> None :
+
+        self.fixture = fixture
+        self.filename = fixture if fixture else filename
+        self.max_dates = max_dates
+
+        self._lock = threading.RLock()
+        self._memory : OrderedDict[dt.date, Dict[str, float]] = OrderedDict()
+        self._disk : Optional[Dict[dt.date, Dict[str, float]]] = None
+
+
+    @property
+    def offline (self) -> bool :
+        return bool(self.fixture)
+
+
+    def _load_disk (self) -> Dict[dt.date, Dict[str, float]] :
+        """
+        Read the whole file once (a few pairs per date, it stays small).
+        """
+        if self._disk is not None :
+            return self._disk
+
+        self._disk = {}
+
+        if not self.filename or not os.path.exists(self.filename) :
+            return self._disk
+
+        try :
+
+            if self.filename.lower().endswith(".csv") :
+                df = pl.read_csv(self.filename, schema_overrides=FX_CACHE_COLUMNS)
+
+            else :
+                df = pl.read_parquet(self.filename)
+
+        except Exception as e :
+
+            print(f"[-] Failed to read FX cache {self.filename}: {e}")
+            return self._disk
+
+        for date, pair, close in df.select(list(FX_CACHE_COLUMNS.keys())).iter_rows() :
+
+            if close is None or math.isnan(close) :
+                continue
+
+            self._disk.setdefault(date, {})[pair] = float(close)
+
+        return self._disk
+
+
+    def _flush_disk (self) -> None :
+        """
+        Rewrite the file atomically (temp file + rename).
+        """
+        if self.offline or not self.filename :
+            return
+
+        rows = [
+            (date, pair, close)
+            for date, values in sorted(self._disk.items())
+            for pair, close in values.items()
+        ]
+
+        df = pl.DataFrame(rows, schema=FX_CACHE_COLUMNS, orient="row")
+
+        try :
+            write_atomic(self.filename, df.write_parquet)
+
+        except Exception as e :
+            print(f"[-] Failed writing FX cache {self.filename}: {e}")
+
+
+    def _remember (self, date : dt.date, values : Dict[str, float]) -> None :
+
+        self._memory[date] = values
+        self._memory.move_to_end(date)
+
+        while len(self._memory) > self.max_dates :
+            self._memory.popitem(last=False)
+
+
+    def get (
+
+            self,
+            date : Optional[str | dt.date | dt.datetime] = None,
+            pairs : Optional[List[str]] = None,
+
+        ) -> Optional[Dict[str, float]] :
+        """
+        Return {pair: close} for the date, or None if any requested pair is missing.
+        """
+        date = str_to_date(date)
+
+        with self._lock :
+
+            values = self._memory.get(date)
+
+            if values is not None :
+                self._memory.move_to_end(date)
+
+            else :
+                values = self._load_disk().get(date)
+
+                if values is not None :
+                    self._remember(date, values)
+
+            if values is None :
+                return None
+
+            if pairs is not None and any(p not in values for p in pairs) :
+                return None
+
+            return {p : values[p] for p in (pairs if pairs is not None else values)}
+
+
+    def latest_before (
+
+            self,
+            date : Optional[str | dt.date | dt.datetime] = None,
+            pair : Optional[str] = None,
+
+        ) -> Optional[float] :
+        """
+        Nearest cached close of `pair` strictly before `date`, or None.
+        """
+        date = str_to_date(date)
+
+        with self._lock :
+
+            known = {**self._load_disk(), **self._memory}
+
+            for d in sorted((d for d in known if d < date), reverse=True) :
+
+                if pair in known[d] :
+                    return known[d][pair]
+
+        return None
+
+
+    def put (
+
+            self,
+            date : Optional[str | dt.date | dt.datetime] = None,
+            values : Optional[Dict[str, float]] = None,
+            persist : bool = True,
+
+        ) -> None :
+        """
+        Store the close values of one date. NaN values are ignored.
+        persist=False keeps them in memory only (e.g. intraday rates of today).
+        """
+        self.put_many({date : values}, persist=persist)
+
+
+    def put_many (
+
+            self,
+            table : Optional[Dict[str | dt.date, Dict[str, float]]] = None,
+            persist : bool = True,
+
+        ) -> None :
+        """
+        Store several dates at once, with a single write of the disk file.
+        """
+        if not table :
+            return
+
+        with self._lock :
+
+            disk = self._load_disk()
+            changed = False
+
+            for date, values in table.items() :
+
+                date = str_to_date(date)
+                clean = {p : float(v) for p, v in (values or {}).items() if v is not None and not math.isnan(v)}
+
+                if not clean :
+                    continue
+
+                merged = {**self._memory.get(date, disk.get(date, {})), **clean}
+                self._remember(date, merged)
+
+                if persist and not self.offline and disk.get(date) != merged :
+
+                    disk[date] = merged
+                    changed = True
+
+            if changed :
+                self._flush_disk()
+
+
+_FX_CACHE : Optional[FxCache] = None
+_FX_CACHE_LOCK = threading.Lock()
+
+
+def get_fx_cache (
+
+        filename : Optional[str] = None,
+        fixture : Optional[str] = None,
+
+    ) -> FxCache :
+    """
+    Return the process-wide FX cache (created on first call).
+    FX_FIXTURE_FILENAME_ABS, when set, switches the cache to offline mode.
+    """
+    global _FX_CACHE
+
+    with _FX_CACHE_LOCK :
+
+        if _FX_CACHE is None :
+
+            filename = FX_CACHE_FILENAME_ABS if filename is None else filename
+            fixture = FX_FIXTURE_FILENAME_ABS if fixture is None else fixture
+
+            _FX_CACHE = FxCache(filename=filename, fixture=fixture)
+
+        return _FX_CACHE
@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import os
+import glob
+import datetime as dt
+import polars as pl
+
+from typing import Optional, Dict, List
+
+from src.config import HISTORY_DIR_ABS_PATH, KINDS_COLUMNS_DICT, KINDS_KEYS_DICT, ALL_FUNDATIONS, ALL_KINDS
+from src.utils import str_to_date, upsert_history_rows, log_key_collisions, write_atomic
+
+
+# Layout :
+#   history/{FUND}/{kind}/{YYYY-MM}.parquet   <- partitions (source of truth)
+#   history/{FUND}/{kind}.xlsx                <- export, rendered once per run
+
+
+def partition_dir (
+
+        fundation : str = "HV",
+        kind : str = "cash",
+        history_dir_abs : Optional[str] = None
+
+    ) -> str :
+    """
+    Return the directory holding the monthly partitions of a (fundation, kind) history.
+    """
+    history_dir_abs = HISTORY_DIR_ABS_PATH if history_dir_abs is None else history_dir_abs
+
+    return os.path.join(history_dir_abs, fundation.upper(), kind)
+
+
+def partition_path (
+
+        fundation : str = "HV",
+        kind : str = "cash",
+        month : str = "1970-01",
+        history_dir_abs : Optional[str] = None
+
+    ) -> str :
+    """
+    Return the parquet file of one partition, e.g. history/HV/cash/2025-11.parquet
+    """
+    return os.path.join(partition_dir(fundation, kind, history_dir_abs), f"{month}.parquet")
+
+
+def excel_export_path (
+
+        fundation : str = "HV",
+        kind : str = "cash",
+        history_dir_abs : Optional[str] = None
+
+    ) -> str :
+    """
+    Return the Excel export path (history/HV/cash.xlsx), same location as the legacy history file.
+    """
+    history_dir_abs = HISTORY_DIR_ABS_PATH if history_dir_abs is None else history_dir_abs
+
+    return os.path.join(history_dir_abs, fundation.upper(), f"{kind}.xlsx")
+
+
+def _conform (df : pl.DataFrame, schema : Dict) -> pl.DataFrame :
+    """
+    Cast and order columns according to the kind schema (missing columns are added as nulls).
+    """
+    exprs = []
+
+    for col, dtype in schema.items() :
+
+        if col in df.columns and dtype == pl.Date and df.schema[col] == pl.Utf8 :
+            exprs.append(pl.col(col).str.to_date("%Y-%m-%d", strict=False))
+
+        elif col in df.columns :
+            exprs.append(pl.col(col).cast(dtype, strict=False))
+
+        else :
+            exprs.append(pl.lit(None, dtype=dtype).alias(col))
+
+    return df.select(exprs)
+
+
+def _month_key (date : dt.date) -> str :
+    return f"{date.year:04d}-{date.month:02d}"
+
+
+def migrate_excel_history (
+
+        fundation : str = "HV",
+        kind : str = "cash",
+        kinds_dict : Optional[Dict] = None,
+        keys_dict : Optional[Dict] = None,
+        history_dir_abs : Optional[str] = None
+
+    ) -> bool :
+    """
+    Seed the parquet partitions from the legacy history/{FUND}/{kind}.xlsx, only once
+    (i.e. when no partition exists yet). Returns True if a migration happened.
+    """
+    kinds_dict = KINDS_COLUMNS_DICT if kinds_dict is None else kinds_dict
+    keys_dict = KINDS_KEYS_DICT if keys_dict is None else keys_dict
+
+    part_dir = partition_dir(fundation, kind, history_dir_abs)
+    legacy = excel_export_path(fundation, kind, history_dir_abs)
+
+    if glob.glob(os.path.join(part_dir, "*.parquet")) or not os.path.exists(legacy) :
+        return False
+
+    schema = kinds_dict.get(kind)
+
+    try :
+        df = pl.read_excel(legacy, schema_overrides=schema)
+
+    except Exception as e :
+
+        print(f"[-] Failed to read legacy history {legacy}: {e}")
+        return False
+
+    df = _conform(df, schema).filter(pl.col("Date").is_not_null())
+
+    # Legacy rows are migrated as they are, keys are not unique (see CASH_KEY_COLUMNS)
+    log_key_collisions(df, keys_dict.get(kind), f"legacy rows of {legacy}")
+
+    for (month,), part in df.group_by(pl.col("Date").dt.strftime("%Y-%m"), maintain_order=True) :
+        write_atomic(partition_path(fundation, kind, month, history_dir_abs), part.write_parquet)
+
+    print(f"\n[+] Migrated {legacy} into parquet partitions ({df.height} rows)")
+
+    return True
+
+
+def read_history (
+
+        fundation : str = "HV",
+        kind : str = "cash",
+
+        start_date : Optional[str | dt.datetime | dt.date] = None,
+        end_date : Optional[str | dt.datetime | dt.date] = None,
+
+        kinds_dict : Optional[Dict] = None,
+        history_dir_abs : Optional[str] = None
+
+    ) -> pl.DataFrame :
+    """
+    Read the history of a (fundation, kind). When a date range is given, only the
+    partitions overlapping it are scanned.
+    """
+    kinds_dict = KINDS_COLUMNS_DICT if kinds_dict is None else kinds_dict
+    schema = kinds_dict.get(kind)
+
+    migrate_excel_history(fundation, kind, kinds_dict, history_dir_abs=history_dir_abs)
+
+    files = sorted(glob.glob(os.path.join(partition_dir(fundation, kind, history_dir_abs), "*.parquet")))
+
+    if start_date is not None or end_date is not None :
+
+        start = str_to_date(start_date) if start_date is not None else dt.date.min
+        end = str_to_date(end_date) if end_date is not None else dt.date.max
+
+        lo, hi = _month_key(start), _month_key(end)
+        files = [f for f in files if lo <= os.path.basename(f)[:-len(".parquet")] <= hi]
+
+    if not files :
+        return pl.DataFrame(schema=schema)
+
+    lf = pl.scan_parquet(files)
+
+    if start_date is not None or end_date is not None :
+        lf = lf.filter(pl.col("Date").is_between(start, end))
+
+    return lf.collect()
+
+
+def append_history (
+
+        df : Optional[pl.DataFrame] = None,
+        fundation : str = "HV",
+        kind : str = "cash",
+
+        kinds_dict : Optional[Dict] = None,
+        keys_dict : Optional[Dict] = None,
+        history_dir_abs : Optional[str] = None
+
+    ) -> List[str] :
+    """
+    Upsert new rows into the history on the natural key of the kind (KINDS_KEYS_DICT) :
+    restated figures replace the stored ones. Only the monthly partitions touched by
+    the dates of `df` are read and rewritten. Returns the list of rewritten partitions.
+    """
+    kinds_dict = KINDS_COLUMNS_DICT if kinds_dict is None else kinds_dict
+    keys_dict = KINDS_KEYS_DICT if keys_dict is None else keys_dict
+
+    schema = kinds_dict.get(kind)
+    keys = keys_dict.get(kind)
+
+    if df is None or df.is_empty() :
+        return []
+
+    migrate_excel_history(fundation, kind, kinds_dict, keys_dict, history_dir_abs)
+
+    new = _conform(df, schema).filter(pl.col("Date").is_not_null())
+    written : List[str] = []
+
+    for (month,), block in new.group_by(pl.col("Date").dt.strftime("%Y-%m"), maintain_order=True) :
+
+        path = partition_path(fundation, kind, month, history_dir_abs)
+
+        try :
+
+            current = pl.read_parquet(path) if os.path.exists(path) else None
+
+            merged = upsert_history_rows(current, block, keys).sort("Date", maintain_order=True)
+            write_atomic(path, merged.write_parquet)
+
+            written.append(path)
+
+        except Exception as e :
+            print(f"[-] Failed writing partition {path}: {e}")
+
+    return written
+
+
+def export_history_to_excel (
+
+        fundations : Optional[List[str]] = None,
+        kinds : Optional[List[str]] = None,
+
+        kinds_dict : Optional[Dict] = None,
+        history_dir_abs : Optional[str] = None
+
+    ) -> List[str] :
+    """
+    Render history/{FUND}/{kind}.xlsx from the parquet partitions.
+    Meant to be called once at the end of a run, not per processed day.
+    """
+    fundations = ALL_FUNDATIONS if fundations is None else fundations
+    kinds = ALL_KINDS if kinds is None else kinds
+
+    exported : List[str] = []
+
+    for fund in fundations :
+
+        for kind in kinds :
+
+            df = read_history(fund, kind, kinds_dict=kinds_dict, history_dir_abs=history_dir_abs)
+
+            if df.is_empty() :
+                continue
+
+            path = excel_export_path(fund, kind, history_dir_abs)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            try :
+
+                df.write_excel(path)
+                exported.append(path)
+
+            except Exception as e :
+                print(f"[-] Failed writing {path}: {e}")
+
+    return exported
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import threading
+import polars as pl
+
+from typing import Optional, Dict, List, Any
+
+from src.config import MAIL_SYNC_FILENAME_ABS
+from src.attachments import FileMetadataCache
+
+
+class MailSyncState (FileMetadataCache) :
+    """
+    Persisted incremental sync state of the shared mailboxes :
+
+        {mailbox : {"YYYY-MM-DD" : {"watermark" : receivedDateTime, "processed" : [message ids]}}}
+
+    The watermark is the latest receivedDateTime already processed for that day, so a
+    rerun only lists the messages received since (Graph `ge`, the boundary message is
+    listed again). The processed ids then drop what was already handled, including a
+    message that shares the watermark timestamp. A message that failed caps the
+    watermark of its day at its own receivedDateTime, so it is listed again.
+
+    Stored as a JSON sidecar (FileMetadataCache : loaded once, rewritten atomically).
+    """
+
+    def flush (self) -> None :
+        """
+        Rewrite the state file atomically (see FileMetadataCache._flush).
+        """
+        with self._lock :
+
+            self._load()
+            self._flush()
+
+
+    def watermark (self, mailbox : str, day : str) -> Optional[str] :
+        """
+        Latest receivedDateTime processed for (mailbox, day), or None if never synced.
+        """
+        with self._lock :
+            return self._load().get(mailbox, {}).get(day, {}).get("watermark")
+
+
+    def new_messages (
+
+            self,
+            inbox_df : pl.DataFrame,
+            column : str = "Received DateTime",
+
+        ) -> pl.DataFrame :
+        """
+        Rows of the inbox frame whose message id was not processed yet for its (mailbox, day).
+        """
+        if inbox_df.is_empty() :
+            return inbox_df
+
+        with self._lock :
+
+            rows = [
+                (mailbox, day, msg_id)
+                for mailbox, days in self._load().items()
+                for day, entry in days.items()
+                for msg_id in entry.get("processed", [])
+            ]
+
+        if not rows :
+            return inbox_df
+
+        done = pl.DataFrame(rows, schema={"Shared Email" : pl.Utf8, "_day" : pl.Utf8, "Id" : pl.Utf8}, orient="row")
+
+        return (
+            inbox_df
+            .with_columns(pl.col(column).str.slice(0, 10).alias("_day"))
+            .join(done, on=["Shared Email", "_day", "Id"], how="anti")
+            .drop("_day")
+        )
+
+
+    def mark_processed (
+
+            self,
+            inbox_df : pl.DataFrame,
+            failed_df : Optional[pl.DataFrame] = None,
+            column : str = "Received DateTime",
+
+        ) -> None :
+        """
+        Record the messages of the frame as processed and move the watermarks forward.
+
+        failed_df : messages of the same run that failed. They are not recorded, and the
+        watermark of their (mailbox, day) is capped at the earliest failed receivedDateTime,
+        so the next run (`ge` watermark) lists them again.
+        Call flush() to persist.
+        """
+        with self._lock :
+
+            state = self._load()
+
+            if not inbox_df.is_empty() :
+
+                for mailbox, msg_id, received in inbox_df.select(["Shared Email", "Id", column]).iter_rows() :
+
+                    if not msg_id or not received :
+                        continue
+
+                    entry = state.setdefault(mailbox, {}).setdefault(received[:10], {"watermark" : None, "processed" : []})
+
+                    if msg_id not in entry["processed"] :
+                        entry["processed"].append(msg_id)
+
+                    if entry["watermark"] is None or received > entry["watermark"] :
+                        entry["watermark"] = received
+
+            if failed_df is None or failed_df.is_empty() :
+                return
+
+            for mailbox, received in failed_df.select(["Shared Email", column]).iter_rows() :
+
+                if not received :
+                    continue
+
+                entry = state.get(mailbox, {}).get(received[:10])
+
+                if entry is not None and entry["watermark"] is not None and entry["watermark"] > received :
+                    entry["watermark"] = received
+
+
+_MAIL_SYNC_STATE : Optional[MailSyncState] = None
+_MAIL_SYNC_STATE_LOCK = threading.Lock()
+
+
+def get_mail_sync_state (filename : Optional[str] = None) -> MailSyncState :
+    """
+    Return the process-wide mail sync state (created on first call).
+    """
+    global _MAIL_SYNC_STATE
+
+    with _MAIL_SYNC_STATE_LOCK :
+
+        if _MAIL_SYNC_STATE is None :
+            _MAIL_SYNC_STATE = MailSyncState(MAIL_SYNC_FILENAME_ABS if filename is None else filename)
+
+        return _MAIL_SYNC_STATE
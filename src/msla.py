@@ -1,66 +1,198 @@
 from __future__ import annotations
 
 import os
+import time
 import requests
-import base64
+import threading
 import msal
 import jwt
 import json
 import datetime as dt
 import polars as pl
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import Dict, List, Optional, Any, Tuple, Union
 
 from src.config import (
     APPLICATION_ID, SECRET_VALUE_ID, AUTHORITY, SCOPES, GRAPH_BASE,
     SHARED_MAILS, EMAIL_COLUMNS, SHARED_MAIL_1, COUNTERPARTIES
 )
-from src.utils import date_to_str
+from src.utils import date_to_str, write_atomic
+from src.mail_sync import MailSyncState
+from src.attachments import AttachmentManifest, get_attachment_manifest, select_attachments, attachment_file_name
 
 
-def get_token (
+class TokenProvider :
+    """
+    App-only Graph token for one (app, authority, scopes).
+
+    The MSAL application is built once and the access token is kept until `margin`
+    seconds before its `exp` claim, so get_token() only hits the authority about once an
+    hour. Tokens issued here are recognized by `refresh` : a caller still holding an old
+    token (e.g. passed down at the start of a long backfill) gets the current one instead.
+    """
+
+    def __init__ (
+
+            self,
+            scopes : Optional[List] = None,
+            app_id : Optional[str] = None,
+            authority : Optional[str] = None,
+            secret : Optional[str] = None,
+            margin : float = 300.0,
+
+        ) -> None :
+
+        self.scopes = SCOPES if scopes is None else scopes
+        self.app_id = APPLICATION_ID if app_id is None else app_id
+        self.authority = AUTHORITY if authority is None else authority
+        self.secret = SECRET_VALUE_ID if secret is None else secret
+        self.margin = margin
+
+        self._lock = threading.RLock()
+        self._app : Optional[msal.ConfidentialClientApplication] = None
+
+        self._token : Optional[str] = None
+        self._expires_at : float = 0.0
+        self._issued : set = set()
+
+
+    def _get_app (self) -> msal.ConfidentialClientApplication :
+
+        if self._app is None :
+
+            self._app = msal.ConfidentialClientApplication(
+
+                client_id=self.app_id,
+                authority=self.authority,
+                client_credential=self.secret
+
+            )
+
+        return self._app
+
+
+    @staticmethod
+    def _expiry (token : str, result : Dict[str, Any]) -> float :
+        """
+        Epoch of expiry from the `exp` claim, else from `expires_in`.
+        """
+        try :
+            return float(jwt.decode(token, options={"verify_signature": False})["exp"])
+
+        except Exception :
+            return time.time() + float(result.get("expires_in", 3599))
+
+
+    def get_token (self, force_refresh : bool = False) -> Optional[str] :
+        """
+        Cached token, re-acquired when it is about to expire (or when forced).
+        """
+        with self._lock :
+
+            if not force_refresh and self._token is not None and time.time() < self._expires_at - self.margin :
+                return self._token
+
+            result = self._get_app().acquire_token_for_client(
+
+                scopes=self.scopes
+
+            )
+
+            if "access_token" in result :
+
+                print("\n[+] Token acquired successfully")
+                print(result["access_token"][:30] + "...")  # Print just token first 30 letters
+
+                self._token = result["access_token"]
+                self._expires_at = self._expiry(self._token, result)
+                self._issued.add(self._token)
+
+            else :
+
+                print("\n[-] Failed to acquire token\n")
+                print(result.get("error_description"))
+
+            return result.get("access_token", self._token if not force_refresh else None)
+
+
+    def refresh (self, token : Optional[str], force_refresh : bool = False) -> Optional[str] :
+        """
+        Current token if `token` was issued by this provider, else `token` unchanged.
+        """
+        if token is None or token not in self._issued :
+            return token
+
+        return self.get_token(force_refresh=force_refresh and token == self._token) or token
+
+
+_TOKEN_PROVIDERS : Dict[Tuple, TokenProvider] = {}
+_TOKEN_PROVIDERS_LOCK = threading.Lock()
+
+
+def get_token_provider (
         
         scopes : Optional[List] = None,
         app_id : Optional[str] =  None,
         authority : Optional[str] = None,
         secret :  Optional[str] = None
     
-    ) -> Optional[str] :
+    ) -> TokenProvider :
     """
-    Function get token from the applcation 
+    Return the process-wide token provider of these credentials (created on first call).
     """
     scopes = SCOPES if scopes is None else scopes
 
     app_id = APPLICATION_ID if app_id is None else app_id
     authority = AUTHORITY if authority is None else authority
     secret = SECRET_VALUE_ID if secret is None else secret
-    
-    app = msal.ConfidentialClientApplication(
 
-        client_id=app_id,
-        authority=authority,
-        client_credential=secret
+    key = (tuple(scopes), app_id, authority, secret)
 
-    )
+    with _TOKEN_PROVIDERS_LOCK :
 
-    result = app.acquire_token_for_client(
+        if key not in _TOKEN_PROVIDERS :
+            _TOKEN_PROVIDERS[key] = TokenProvider(list(scopes), app_id, authority, secret)
 
-        scopes=scopes
+        return _TOKEN_PROVIDERS[key]
 
-    )
 
+def get_token (
         
-    if "access_token" in result :
-
-        print("\n[+] Token acquired successfully")
-        print(result["access_token"][:30] + "...")  # Print just token first 30 letters
+        scopes : Optional[List] = None,
+        app_id : Optional[str] =  None,
+        authority : Optional[str] = None,
+        secret :  Optional[str] = None
     
-    else :
+    ) -> Optional[str] :
+    """
+    Function get token from the applcation (cached, see TokenProvider)
+    """
+    return get_token_provider(scopes, app_id, authority, secret).get_token()
+
+
+def refresh_bearer (headers : Optional[Dict[str, str]], force_refresh : bool = False) -> Optional[Dict[str, str]] :
+    """
+    Same headers with the bearer token swapped for the current one of the provider
+    that issued it (no change for a token unknown to every provider).
+    """
+    auth = (headers or {}).get("Authorization", "")
+
+    if not auth.startswith("Bearer ") :
+        return headers
+
+    token = auth[len("Bearer "):]
+
+    for provider in list(_TOKEN_PROVIDERS.values()) :
+
+        fresh = provider.refresh(token, force_refresh)
 
-        print("\n[-] Failed to acquire token\n")
-        print(result.get("error_description"))
+        if fresh != token :
+            return {**headers, "Authorization": f"Bearer {fresh}"}
 
-    return result.get("access_token", None)
+    return headers
 
 
 def decode_token (token : str) -> List[Dict[str, Any]] :
@@ -84,21 +216,79 @@ def get_inbox_messages_by_date (
         email : Optional[str] = None,
         graph_base : Optional[str] = None,
         with_attach : bool = False,
-        format : str = ""
+        format : str = "",
+        max_retries : int = 5,
+        since : Optional[str] = None
 
     ) :
     """
-    
+    List the Inbox messages received on `date` (UTC day) in a shared mailbox.
+    Throttled responses (429/503) are retried after the Retry-After delay given by Graph.
+    since : receivedDateTime watermark (incremental sync), only messages received at or
+            after it are listed.
     """
-    token = get_token() if token is None else token
-    graph_base = GRAPH_BASE if graph_base is None else graph_base
-    email = SHARED_MAILS[0] if email is None else email
-
     date = date_to_str(date)
     start, end = get_day_bounds(date)
 
+    if since is not None and start < since < end :
+        start = since
+
     filter_str = f"receivedDateTime ge {start} and receivedDateTime lt {end}"
 
+    return list_inbox_messages(filter_str, token, email, graph_base, with_attach, max_retries)
+
+
+def get_inbox_messages_by_range (
+
+        start_date : Optional[str | dt.datetime | dt.date] = None,
+        end_date : Optional[str | dt.datetime | dt.date] = None,
+        token : Optional[str] = None,
+        email : Optional[str] = None,
+        graph_base : Optional[str] = None,
+        with_attach : bool = False,
+        days : int = 7,
+        max_retries : int = 5
+
+    ) -> pl.DataFrame :
+    """
+    List the Inbox messages received between start_date and end_date (UTC days, inclusive)
+    with one query per `days`-long window (see build_chunks) instead of one per day.
+    Use partition_inbox_by_day to split the result back into days.
+    """
+    frames : List[pl.DataFrame] = []
+
+    for start, end in build_chunks(start_date, end_date, days) :
+
+        filter_str = f"receivedDateTime ge {start} and receivedDateTime le {end}"
+        df_chunk = list_inbox_messages(filter_str, token, email, graph_base, with_attach, max_retries)
+
+        if isinstance(df_chunk, pl.DataFrame) and not df_chunk.is_empty() :
+            frames.append(df_chunk)
+
+    if not frames :
+        return pl.DataFrame(schema=EMAIL_COLUMNS)
+
+    return pl.concat(frames, how="vertical_relaxed")
+
+
+def list_inbox_messages (
+
+        filter_str : str,
+        token : Optional[str] = None,
+        email : Optional[str] = None,
+        graph_base : Optional[str] = None,
+        with_attach : bool = False,
+        max_retries : int = 5
+
+    ) -> pl.DataFrame :
+    """
+    Run a $filter query on the Inbox of a shared mailbox and follow @odata.nextLink
+    until every page is read.
+    """
+    token = get_token() if token is None else token
+    graph_base = GRAPH_BASE if graph_base is None else graph_base
+    email = SHARED_MAILS[0] if email is None else email
+
     parameters = {
         
         "$orderby": "receivedDateTime ASC",
@@ -126,13 +316,7 @@ def get_inbox_messages_by_date (
     
     while True :
 
-        response = requests.get(
-            
-            url=url,
-            headers=headers,
-            params=parameters
-
-        )
+        response = graph_get_with_retry(url, headers, parameters, max_retries)
 
         if response.status_code != 200 :
             raise Exception(f"Graph API error {response.status_code}: {response.text}")
@@ -149,7 +333,8 @@ def get_inbox_messages_by_date (
                     "From" : m.get("from", {}).get("emailAddress", {}).get("address"),
                     "Received DateTime" : m.get("receivedDateTime"),
                     "Attachments" : m.get("hasAttachments"),
-                    "Shared Email" : str(email)
+                    "Shared Email" : str(email),
+                    "Attachments Meta" : json.dumps(m["attachments"]) if "attachments" in m else None
                 }
             
             )
@@ -161,161 +346,514 @@ def get_inbox_messages_by_date (
             break
         
         url = next_link
-        params = None  # already encoded in nextLink
+        parameters = None  # already encoded in nextLink
 
     df_email = pl.DataFrame(rows, schema_overrides=EMAIL_COLUMNS)
 
     return df_email
 
 
+def partition_inbox_by_day (
+        
+        inbox_df : pl.DataFrame,
+        dates : Optional[List[str]] = None,
+        column : str = "Received DateTime"
+    
+    ) -> Dict[str, pl.DataFrame] :
+    """
+    Split an inbox frame by UTC day ('YYYY-MM-DD'; Graph datetimes are UTC ISO strings).
+    When dates is given, every one of them is in the output (empty frame if no message).
+    """
+    out : Dict[str, pl.DataFrame] = {}
+
+    if not inbox_df.is_empty() :
+
+        by_day = inbox_df.with_columns(pl.col(column).str.slice(0, 10).alias("_day"))
+
+        for (day,), part in by_day.group_by("_day", maintain_order=True) :
+
+            if day is not None :
+                out[day] = part.drop("_day")
+
+    if dates is not None :
+        out = {d : out.get(d, inbox_df.clear()) for d in dates}
+
+    return out
+
+
+class GraphClient :
+    """
+    Pooled HTTP client for every Graph call of the pipeline.
+
+    One requests.Session is shared by all threads : connections to graph.microsoft.com
+    stay alive (no TLS handshake per page or attachment) and the pool is sized for the
+    fan-out of fetch_inbox_messages. The transport adapter retries connection errors and
+    5xx gateway errors; throttling (429/503) is handled in `get` with Retry-After.
+    """
+
+    def __init__ (
+
+            self,
+            pool_connections : int = 4,
+            pool_maxsize : int = 16,
+            total_retries : int = 3,
+            backoff_factor : float = 0.5,
+            timeout : float = 120.0,
+
+        ) -> None :
+
+        self.timeout = timeout
+
+        retry = Retry(
+
+            total=total_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 504),
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False,
+
+        )
+
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+
+    def get (
+
+            self,
+            url : str,
+            headers : Optional[Dict[str, str]] = None,
+            params : Optional[Dict[str, str]] = None,
+            max_retries : int = 5,
+            default_wait : float = 2.0,
+            max_wait : float = 60.0,
+            stream : bool = False,
+
+        ) -> requests.Response :
+        """
+        GET on Graph honoring throttling : on 429/503 wait for Retry-After (seconds) when
+        present, else an exponential delay, then retry. The last response is returned as is.
+        """
+        headers = refresh_bearer(headers)
+        reauth = True
+
+        for attempt in range(max_retries + 1) :
+
+            response = self.session.get(url=url, headers=headers, params=params, stream=stream, timeout=self.timeout)
+
+            # Token expired mid-run : once, retry with a freshly acquired one
+            if response.status_code == 401 and reauth and attempt < max_retries :
+
+                fresh = refresh_bearer(headers, force_refresh=True)
+                reauth = False
+
+                if fresh is not headers :
+
+                    response.close()
+                    headers = fresh
+                    continue
+
+            if response.status_code not in (429, 503) or attempt == max_retries :
+                return response
+
+            retry_after = response.headers.get("Retry-After")
+
+            try :
+                wait = float(retry_after) if retry_after is not None else default_wait * (2 ** attempt)
+
+            except ValueError :
+                wait = default_wait * (2 ** attempt)
+
+            wait = min(wait, max_wait)
+            response.close()
+
+            print(f"[!] Graph throttled ({response.status_code}), retrying in {wait:.0f}s...")
+            time.sleep(wait)
+
+        return response
+
+
+    def close (self) -> None :
+        self.session.close()
+
+
+_GRAPH_CLIENT : Optional[GraphClient] = None
+_GRAPH_CLIENT_LOCK = threading.Lock()
+
+
+def get_graph_client () -> GraphClient :
+    """
+    Return the process-wide Graph client (created on first call).
+    """
+    global _GRAPH_CLIENT
+
+    with _GRAPH_CLIENT_LOCK :
+
+        if _GRAPH_CLIENT is None :
+            _GRAPH_CLIENT = GraphClient()
+
+        return _GRAPH_CLIENT
+
+
+# Graph allows a few concurrent requests per mailbox, beyond that it throttles (429)
+MAILBOX_CONCURRENCY = 4
+
+_MAILBOX_SLOTS : Dict[str, threading.BoundedSemaphore] = {}
+_MAILBOX_SLOTS_LOCK = threading.Lock()
+
+
+def mailbox_slot (mailbox : Optional[str]) -> threading.BoundedSemaphore :
+    """
+    Semaphore bounding the concurrent Graph requests on one mailbox (use as `with`).
+    """
+    key = str(mailbox).lower()
+
+    with _MAILBOX_SLOTS_LOCK :
+
+        if key not in _MAILBOX_SLOTS :
+            _MAILBOX_SLOTS[key] = threading.BoundedSemaphore(MAILBOX_CONCURRENCY)
+
+        return _MAILBOX_SLOTS[key]
+
+
+def graph_get_with_retry (
+
+        url : str,
+        headers : Dict[str, str],
+        params : Optional[Dict[str, str]] = None,
+        max_retries : int = 5,
+        default_wait : float = 2.0,
+        max_wait : float = 60.0
+
+    ) -> requests.Response :
+    """
+    GET through the shared Graph client (see GraphClient.get).
+    """
+    return get_graph_client().get(url, headers, params, max_retries, default_wait, max_wait)
+
+
+def fetch_inbox_messages (
+
+        dates : Optional[List[str | dt.datetime | dt.date]] = None,
+        token : Optional[str] = None,
+        shared_emails : Optional[List[str]] = None,
+        with_attach : bool = True,
+
+        schema_df : Optional[Dict[str, Any]] = None,
+        max_workers : int = 4,
+        chunk_days : Optional[int] = None,
+        sync_state : Optional[MailSyncState] = None,
+
+    ) -> pl.DataFrame :
+    """
+    Fan out get_inbox_messages_by_date over every (mailbox, date) pair with at most
+    `max_workers` requests in flight, and merge the results in a single inbox frame.
+    A failing pair is reported and skipped.
+
+    chunk_days : range mode, each mailbox is listed with one query per `chunk_days`
+    window covering the dates (get_inbox_messages_by_range) instead of one per date;
+    messages of days outside `dates` (e.g. weekends inside a window) are dropped.
+
+    sync_state : incremental mode, each (mailbox, date) is listed from its watermark
+    (per date listing, chunk_days is ignored).
+    """
+    dates = [date_to_str()] if dates is None else dates
+    token = get_token() if token is None else token
+    shared_emails = SHARED_MAILS if shared_emails is None else shared_emails
+    schema_df = EMAIL_COLUMNS if schema_df is None else schema_df
+
+    frames : List[pl.DataFrame] = [pl.DataFrame(schema=schema_df)]
+    dates = [date_to_str(d) for d in dates]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as ex :
+
+        if chunk_days and sync_state is None :
+
+            futures = {
+                ex.submit(get_inbox_messages_by_range, start_date=s[:10], end_date=e[:10], token=token, email=email, with_attach=with_attach, days=chunk_days) : (email, f"{s[:10]}..{e[:10]}")
+                for email in shared_emails
+                for s, e in build_chunks(min(dates), max(dates), chunk_days)
+            }
+
+        else :
+
+            futures = {
+                ex.submit(
+                    get_inbox_messages_by_date, date=d, token=token, email=email, with_attach=with_attach,
+                    since=sync_state.watermark(email, d) if sync_state is not None else None
+                ) : (email, d)
+                for d in dates
+                for email in shared_emails
+            }
+
+        for fut in as_completed(futures) :
+
+            email, d = futures[fut]
+
+            try :
+                df_email = fut.result()
+
+            except Exception as e :
+
+                print(f"\n[-] Inbox read error {email} {d}: {e}")
+                continue
+
+            if isinstance(df_email, pl.DataFrame) and not df_email.is_empty() :
+                frames.append(df_email)
+
+    inbox_df = pl.concat(frames, how="vertical_relaxed")
+
+    if chunk_days and sync_state is None :
+        inbox_df = inbox_df.filter(pl.col("Received DateTime").str.slice(0, 10).is_in(dates))
+
+    return inbox_df
+
+
 def download_attachments_for_message (
 
         message_id: str,
         token : Optional[str] = None,
         out_dir : Optional[str] = "attachments",
         user_upn: Optional[str] = None,
-        attachment : Optional[str] = "/attachments"
+        attachment : Optional[str] = "/attachments",
+        attachments_meta : Optional[List[Dict[str, Any]]] = None,
+        manifest : Optional[AttachmentManifest] = None,
+        name_rules : Optional[List[str]] = None,
+        max_workers : int = 4
     
-    ) -> Optional[List] :
+    ) -> Tuple[List[str], List[str]] :
     """
     message_id: the Graph message id (string)
     user_upn: optional, e.g. 'alice@example.com'; when provided use /users/{user_upn}/messages/{id}
               otherwise uses /me/messages/{id}
+    attachments_meta: attachment metadata already listed with the message ($expand, see the
+              "Attachments Meta" inbox column). Attachments found in the manifest are not
+              fetched again and no listing request is made.
+    name_rules: only attachments whose name contains one of these (case-insensitive) are
+              saved, e.g. ATTACHMENT_NAME_RULES[counterparty]. With attachments_meta the
+              others are never fetched.
+    max_workers: attachments of the message downloaded in parallel (streamed, see
+              stream_attachment_value). Whatever the number of callers, at most
+              MAILBOX_CONCURRENCY requests run at once on `user_upn`.
+
+    Returns (downloaded, skipped) : the paths written by this call, and the paths of the
+    attachments already on disk (manifest hits) that were not fetched.
     """
     token = get_token() if token is None else token
     user_upn = SHARED_MAIL_1 if user_upn is None else user_upn
+    manifest = get_attachment_manifest() if manifest is None else manifest
 
     os.makedirs(out_dir, exist_ok=True)
 
     headers = {"Authorization": f"Bearer {token}"}
     base = f"{GRAPH_BASE}/users/{user_upn}/messages/{message_id}"
-
-    # List attachments
     list_url = base + attachment
-    r = requests.get(
-    
-        list_url,
-        headers=headers
-    
-    )
 
-    r.raise_for_status()
-    
-    attachments = r.json().get("value", [])
+    downloaded : List[str] = []
+    skipped : List[str] = []
+
+    if attachments_meta is not None :
+
+        wanted = select_attachments(attachments_meta, name_rules)
+
+        if not wanted :
+
+            print(f"[*] No attachment of {message_id[-12:]} matches the filename rules, skipped.")
+            return downloaded, skipped
+
+        attachments_meta = wanted
+        missing = []
+
+        for meta in attachments_meta :
+
+            existing = manifest.present(message_id, meta)
 
-    if not attachments :
+            if existing is not None :
+                skipped.append(existing)
+
+            else :
+                missing.append(meta)
+
+        if not missing :
+
+            print(f"[*] Attachments of {message_id[-12:]} already on disk, skipped.")
+            return downloaded, skipped
+
+        # Metadata is enough, the content itself is streamed from /$value
+        attachments = missing
+
+    else :
+
+        # List attachments (metadata only, no base64 contentBytes)
+        with mailbox_slot(user_upn) :
+            r = graph_get_with_retry(list_url, headers, {"$select": "id,name,contentType,size,isInline"})
+
+        r.raise_for_status()
+        
+        attachments = select_attachments(r.json().get("value", []), name_rules)
+
+    if not attachments and not skipped :
 
         print("[-] No attachments found.")
-        return []
+        return downloaded, skipped
 
-    saved = []
+    todo = []
 
     for att in attachments :
 
-        att_id = att.get("id")
-        att_name = att.get("name") or att.get("contentType") or f"attachment-{att_id}"
-        odata_type = att.get("@odata.type", "")
+        existing = manifest.present(message_id, att)
 
-        # fileAttachment: contains contentBytes (base64)
-        if odata_type.lower().endswith("fileattachment") :
+        if existing is not None :
+            skipped.append(existing)
 
-            content_b64 = att.get("contentBytes")
-            
-            if content_b64 :
+        else :
+            todo.append(att)
 
-                data = base64.b64decode(content_b64)
-                path = os.path.join(out_dir, att_name)
-                
-                with open(path, "wb") as f :
-                    f.write(data)
+    if todo :
 
-                saved.append(path)
-                print("[*] Saved file Attachment at ", path)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(todo)))) as ex :
 
-            else :
+            futures = {ex.submit(save_attachment, att, list_url, headers, out_dir, user_upn) : att for att in todo}
 
-                # fallback: fetch full attachment by id
-                get_url = f"{list_url}/{att_id}"
-                
-                rr = requests.get(
-                
-                    get_url,
-                    headers=headers
-                
-                )
-
-                rr.raise_for_status()
-                
-                full = rr.json()
-                cb = full.get("contentBytes")
-                
-                if cb :
-
-                    path = os.path.join(out_dir, full.get("name", att_name))
-                    
-                    with open(path, "wb") as f :
-                        f.write(base64.b64decode(cb))
-
-                    saved.append(path)
-                    print("[+] Saved (fetched) fileAttachment ->", path)
-                
-                else :
-                    print("[*] Attachment missing contentBytes:", att_id)
-
-        # itemAttachment: embedded message/event/contact (may contain an 'item' property)
-        elif odata_type.lower().endswith("itemattachment") :
-
-            # You can GET the attachment by id to inspect the embedded item
-            get_url = f"{list_url}/{att_id}"
-            
-            rr = requests.get(
-            
-                get_url,
-                headers=headers
-            
-            )
+            for fut in as_completed(futures) :
 
-            rr.raise_for_status()
-            item = rr.json().get("item")
-            
-            # Save the embedded item's subject/body as .eml or .json
-            fname = att.get("name") or f"embedded-{att_id}.json"
-            path = os.path.join(out_dir, fname)
-            
-            with open(path, "w", encoding="utf-8") as f :
-                json.dump(item, f, ensure_ascii=False, indent=2)
-            
-            saved.append(path)
-            print("Saved itemAttachment (JSON) ->", path)
+                att = futures[fut]
+                path = fut.result()
 
-        # referenceAttachment: link to content in cloud (OneDrive/SharePoint etc.)
-        elif odata_type.lower().endswith("referenceattachment") :
+                if path is not None :
 
-            # referenceAttachment contains a 'sourceUrl' or other metadata
-            src = att.get("sourceUrl") or att.get("contentLocation")
-            
-            info_path = os.path.join(out_dir, f"reference-{att_id}.txt")
-            
-            with open(info_path, "w", encoding="utf-8") as f :
-                f.write(f"Reference attachment metadata:\n{att}\n\nSource URL: {src}\n")
-            
-            saved.append(info_path)
-            print("Saved referenceAttachment metadata ->", info_path)
+                    downloaded.append(path)
+                    manifest.record(message_id, att, path, flush=False)
 
-        else:
-            # Unknown type: try fetching by id
-            get_url = f"{list_url}/{att_id}"
-            
-            rr = requests.get(get_url, headers=headers)
-            rr.raise_for_status()
-            
-            with open(os.path.join(out_dir, f"unknown-{att_id}.json"), "w", encoding="utf-8") as f:
-                import json
-                json.dump(rr.json(), f, ensure_ascii=False, indent=2)
-            print("Saved unknown attachment metadata for inspection:", att_id)
+        manifest.flush()
+
+    return downloaded, skipped
+
+
+def save_attachment (
+
+        att : Dict[str, Any],
+        list_url : str,
+        headers : Dict[str, str],
+        out_dir : str,
+        mailbox : Optional[str] = None
+
+    ) -> Optional[str] :
+    """
+    Write one attachment (as returned by Graph) into out_dir. Returns the path written.
+    The request holds one of the mailbox slots (see mailbox_slot).
+    """
+    with mailbox_slot(mailbox) :
+        return _save_attachment(att, list_url, headers, out_dir)
+
+
+def _save_attachment (
 
-    return saved
+        att : Dict[str, Any],
+        list_url : str,
+        headers : Dict[str, str],
+        out_dir : str
+
+    ) -> Optional[str] :
+    att_id = att.get("id")
+    att_name = attachment_file_name(att)
+    odata_type = att.get("@odata.type", "")
+
+    # fileAttachment: raw content streamed from /$value (type may be absent from $expand metadata)
+    if not odata_type or odata_type.lower().endswith("fileattachment") :
+
+        path = os.path.join(out_dir, att_name)
+        stream_attachment_value(f"{list_url}/{att_id}/$value", headers, path)
+
+        print("[*] Saved file Attachment at ", path)
+        return path
+
+    # itemAttachment: embedded message/event/contact (may contain an 'item' property)
+    if odata_type.lower().endswith("itemattachment") :
+
+        # You can GET the attachment by id to inspect the embedded item
+        get_url = f"{list_url}/{att_id}"
+        
+        rr = graph_get_with_retry(get_url, headers)
+
+        rr.raise_for_status()
+        item = rr.json().get("item")
+        
+        # Save the embedded item's subject/body as .eml or .json
+        fname = att.get("name") or f"embedded-{att_id}.json"
+        path = os.path.join(out_dir, fname)
+        
+        with open(path, "w", encoding="utf-8") as f :
+            json.dump(item, f, ensure_ascii=False, indent=2)
+        
+        print("Saved itemAttachment (JSON) ->", path)
+        return path
+
+    # referenceAttachment: link to content in cloud (OneDrive/SharePoint etc.)
+    elif odata_type.lower().endswith("referenceattachment") :
+
+        # referenceAttachment contains a 'sourceUrl' or other metadata
+        src = att.get("sourceUrl") or att.get("contentLocation")
+        
+        info_path = os.path.join(out_dir, f"reference-{att_id}.txt")
+        
+        with open(info_path, "w", encoding="utf-8") as f :
+            f.write(f"Reference attachment metadata:\n{att}\n\nSource URL: {src}\n")
+        
+        print("Saved referenceAttachment metadata ->", info_path)
+        return info_path
+
+    # Unknown type: try fetching by id
+    get_url = f"{list_url}/{att_id}"
+    
+    rr = graph_get_with_retry(get_url, headers)
+    rr.raise_for_status()
     
+    with open(os.path.join(out_dir, f"unknown-{att_id}.json"), "w", encoding="utf-8") as f:
+        json.dump(rr.json(), f, ensure_ascii=False, indent=2)
+
+    print("Saved unknown attachment metadata for inspection:", att_id)
+    return None
+    
+
+def stream_attachment_value (
+
+        url : str,
+        headers : Dict[str, str],
+        path : str,
+        chunk_size : int = 1 << 20
+
+    ) -> str :
+    """
+    Stream the raw bytes of an attachment (.../attachments/{id}/$value) into `path` by
+    chunks : written through write_atomic, so a failed transfer never leaves a truncated
+    file behind and memory stays at one chunk whatever the file size.
+
+    The temp file is unique per thread, so two writers on the same final name do not mix
+    their bytes : the last complete transfer wins the rename. Which one that is, is up to
+    the caller (see main.download_routed_attachments, which runs messages sharing a file
+    name in receivedDateTime order).
+    """
+    def _stream (tmp : str) -> None :
+
+        with get_graph_client().get(url, headers, stream=True) as response :
+
+            response.raise_for_status()
+
+            with open(tmp, "wb") as f :
+
+                for chunk in response.iter_content(chunk_size=chunk_size) :
+
+                    if chunk :
+                        f.write(chunk)
+
+    write_atomic(path, _stream)
+
+    return path
+
 
 def build_chunks(
         
@@ -325,29 +863,30 @@ def build_chunks(
 
     ) -> List[Tuple[str, str]] :
     """
-    Return list of [start_iso, end_iso] for each chunk. End exclusive.
+    Return list of [start_iso, end_iso] for each chunk of `days` days. End inclusive
+    (last millisecond of the chunk's last day), e.g. for a 'receivedDateTime le' filter.
     """
-    s = date_to_str(start_date)
-    e = date_to_str(end_date)
+    s = dt.datetime.strptime(date_to_str(start_date), "%Y-%m-%d")
+    e = dt.datetime.strptime(date_to_str(end_date), "%Y-%m-%d")
     
     if s > e:
         s, e = e, s
     
     out: List[Tuple[str, str]] = []
-    step = dt.timedelta(days=days)
+    step = dt.timedelta(days=max(days, 1))
 
     cur = s
 
     while cur <= e :
 
-        nxt = min(cur + step - dt.timedelta(milliseconds=1), e)
+        nxt = min(cur + step - dt.timedelta(days=1), e)
         
         out.append((
             cur.strftime("%Y-%m-%dT00:00:00Z"),
             nxt.strftime("%Y-%m-%dT23:59:59.999Z"),
         ))
         
-        cur = (nxt + dt.timedelta(milliseconds=1))
+        cur = nxt + dt.timedelta(days=1)
     
     return out
 
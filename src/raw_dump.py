@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import os
+import json
+import threading
+import polars as pl
+
+from typing import Optional, List
+
+from src.config import RAW_DIR_ABS_PATH, RAW_DUMP_FORMAT, EMAIL_COLUMNS
+from src.utils import date_to_str, write_atomic
+
+
+# Layout (audit copy of the routed inbox rows) :
+#   raw/{counterparty}/{YYYY-MM}.parquet   <- RAW_DUMP_FORMAT = "parquet" (default), upsert on Id
+#   raw/{counterparty}/{YYYY-MM}.ndjson    <- RAW_DUMP_FORMAT = "ndjson", append only
+#   raw/{counterparty}_{date}.xlsx         <- RAW_DUMP_FORMAT = "xlsx" (legacy), or export_raw_dump_to_excel
+# RAW_DUMP_FORMAT = "none" disables the dump.
+
+RAW_DUMP_FORMATS = ("parquet", "ndjson", "xlsx", "none")
+
+_RAW_DUMP_LOCK = threading.Lock()
+
+
+def raw_dump_path (
+
+        counterparty : str,
+        date : Optional[str] = None,
+        fmt : Optional[str] = None,
+        raw_dir_abs : Optional[str] = None
+
+    ) -> str :
+    """
+    Return the dump file of a counterparty for the month of `date` (or the day, for xlsx).
+    """
+    fmt = RAW_DUMP_FORMAT if fmt is None else fmt
+    raw_dir_abs = RAW_DIR_ABS_PATH if raw_dir_abs is None else raw_dir_abs
+    date = date_to_str(date)
+
+    if fmt == "xlsx" :
+        return os.path.join(raw_dir_abs, f"{counterparty.lower()}_{date}.xlsx")
+
+    return os.path.join(raw_dir_abs, counterparty.lower(), f"{date[:7]}.{fmt}")
+
+
+def write_raw_dump (
+
+        df : pl.DataFrame,
+        counterparty : str,
+        date : Optional[str] = None,
+        fmt : Optional[str] = None,
+        raw_dir_abs : Optional[str] = None
+
+    ) -> Optional[str] :
+    """
+    Store the routed inbox rows of a counterparty for one date. Returns the file written.
+
+    parquet : the monthly file is rewritten (temp file + rename) with the rows upserted on Id,
+              so rerunning a date does not duplicate its messages.
+    ndjson  : rows are appended to the monthly file.
+    xlsx    : one workbook per (counterparty, date), as before (slow, audit on demand only).
+    """
+    fmt = RAW_DUMP_FORMAT if fmt is None else fmt
+
+    if fmt not in RAW_DUMP_FORMATS :
+
+        print(f"[-] Unknown raw dump format {fmt}, expected one of {RAW_DUMP_FORMATS}")
+        return None
+
+    if fmt == "none" or df is None or df.is_empty() :
+        return None
+
+    path = raw_dump_path(counterparty, date, fmt, raw_dir_abs)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if fmt == "xlsx" :
+
+        df.drop("Attachments Meta", strict=False).write_excel(path)
+        return path
+
+    with _RAW_DUMP_LOCK :
+
+        if fmt == "ndjson" :
+
+            with open(path, "a", encoding="utf-8") as f :
+
+                for row in df.to_dicts() :
+                    f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+
+            return path
+
+        if os.path.exists(path) :
+
+            current = pl.read_parquet(path)
+            df = pl.concat([current.join(df.select("Id"), on="Id", how="anti"), df], how="diagonal_relaxed")
+
+        write_atomic(path, df.sort("Received DateTime").write_parquet)
+
+    return path
+
+
+def read_raw_dump (
+
+        counterparty : str,
+        date : Optional[str] = None,
+        fmt : Optional[str] = None,
+        raw_dir_abs : Optional[str] = None
+
+    ) -> pl.DataFrame :
+    """
+    Rows dumped for a counterparty on `date` (UTC day of Received DateTime).
+    """
+    fmt = RAW_DUMP_FORMAT if fmt is None else fmt
+    date = date_to_str(date)
+    path = raw_dump_path(counterparty, date, fmt, raw_dir_abs)
+
+    if not os.path.exists(path) :
+        return pl.DataFrame(schema=EMAIL_COLUMNS)
+
+    if fmt == "xlsx" :
+        return pl.read_excel(path)
+
+    if fmt == "ndjson" :
+        df = pl.read_ndjson(path, schema=EMAIL_COLUMNS).unique(subset="Id", keep="last", maintain_order=True)
+
+    else :
+        df = pl.read_parquet(path)
+
+    return df.filter(pl.col("Received DateTime").str.slice(0, 10) == date)
+
+
+def export_raw_dump_to_excel (
+
+        counterparties : List[str],
+        date : Optional[str] = None,
+        fmt : Optional[str] = None,
+        raw_dir_abs : Optional[str] = None
+
+    ) -> List[str] :
+    """
+    Render the legacy raw/{counterparty}_{date}.xlsx audit files from the columnar dump.
+    """
+    fmt = RAW_DUMP_FORMAT if fmt is None else fmt
+    written : List[str] = []
+
+    for counterparty in counterparties :
+
+        df = read_raw_dump(counterparty, date, fmt, raw_dir_abs)
+
+        if df.is_empty() :
+            continue
+
+        path = raw_dump_path(counterparty, date, "xlsx", raw_dir_abs)
+
+        try :
+
+            df.drop("Attachments Meta", strict=False).write_excel(path)
+            written.append(path)
+
+        except Exception as e :
+            print(f"[-] Failed writing {path}: {e}")
+
+    return written
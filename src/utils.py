@@ -1,15 +1,17 @@
 from __future__ import annotations
 
 import os
+import atexit
+import threading
 import datetime as dt
 import polars as pl
 
 from src.config import (FUNDATIONS, FREQUENCY_DATE_MAP, HISTORY_DIR_ABS_PATH,
     CACHE_DIR_ABS_PATH, ATTACH_DIR_ABS_PATH, RAW_DIR_ABS_PATH, KINDS_COLUMNS_DICT,
-    CACHE_FILENAME_ABS, CACHE_COLUMNS, CASH_COLUMNS
+    CACHE_FILENAME_ABS, CACHE_COLUMNS, CASH_COLUMNS, KINDS_KEYS_DICT
 )
 
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple, Callable, Any
 
 
 def date_to_str (date : Optional[str | dt.datetime] = None, format : str = "%Y-%m-%d") -> str :
@@ -286,13 +288,12 @@ def update_cash_history (
 
     if df_new is not None :
 
-        df_unique = check_and_filter_history_rows(df_new, df_hist, schema_overrides)
-
-        df_hist = df_hist.vstack(df_unique)
+        df_new = df_new.select([pl.col(c).cast(t, strict=False) for c, t in schema_overrides.items() if c in df_new.columns])
+        df_hist = upsert_history_rows(df_hist, df_new, KINDS_KEYS_DICT.get(kind))
 
     return df_hist
 
-# TODO
+
 def check_and_filter_history_rows (
         
         df_new : Optional[pl.DataFrame] = None,
@@ -300,23 +301,75 @@ def check_and_filter_history_rows (
 
         schema_overrides : Optional[Dict] = None,
 
-    ) :
+    ) -> pl.DataFrame :
     """
-    
+    Return the rows of df_new that are not already (exactly) in df_hist.
     """
     schema_overrides = CASH_COLUMNS if schema_overrides is None else schema_overrides
 
-    hist_rows_set = set(tuple(row) for row in df_hist.to_numpy())
-    new_rows = [tuple(row) for row in df_new.to_numpy()]
-    
-    unique_rows = [row for row in new_rows if row not in hist_rows_set]
-    
-    # Si des lignes uniques existent, les convertir en DataFrame et retourner
-    if unique_rows:
-        return pl.DataFrame(unique_rows, schema=df_new.columns)
-    else:
-        return pl.DataFrame(columns=df_new.columns)
+    if df_hist is None or df_hist.is_empty() :
+        return df_new
+
+    on = [c for c in df_new.columns if c in df_hist.columns]
+
+    return df_new.join(df_hist.select(on).unique(), on=on, how="anti", nulls_equal=True)
+
+
+def upsert_history_rows (
+        
+        df_hist : Optional[pl.DataFrame] = None,
+        df_new : Optional[pl.DataFrame] = None,
+
+        keys : Optional[List[str]] = None,
+
+    ) -> pl.DataFrame :
+    """
+    Keyed upsert of df_new into df_hist.
+
+    Rows of df_new replace the history rows with the same natural key (restated figures),
+    other rows are appended. Only history rows of the dates present in df_new are joined,
+    the rest of the history is passed through untouched.
+
+    Every row of df_new is kept, including rows sharing a key (see CASH_KEY_COLUMNS),
+    which are only reported.
+    """
+    keys = KINDS_KEYS_DICT.get("cash") if keys is None else keys
+
+    if df_new is None or df_new.is_empty() :
+        return df_hist
+
+    log_key_collisions(df_new, keys, "new history rows")
+
+    if df_hist is None or df_hist.is_empty() :
+        return df_new
+
+    touched = pl.col("Date").is_in(df_new.get_column("Date").unique().implode())
+
+    untouched_df = df_hist.filter(~touched | pl.col("Date").is_null())
+    kept_df = df_hist.filter(touched).join(df_new.select(keys), on=keys, how="anti", nulls_equal=True)
+
+    return pl.concat([untouched_df, kept_df, df_new], how="vertical_relaxed")
+
 
+def log_key_collisions (
+
+        df : Optional[pl.DataFrame] = None,
+        keys : Optional[List[str]] = None,
+        label : str = "rows"
+
+    ) -> int :
+    """
+    Print how many rows of df share their natural key with another row. Returns that count.
+    """
+    if df is None or df.is_empty() or not keys :
+        return 0
+
+    collisions = df.filter(pl.len().over(keys) > 1).height
+
+    if collisions :
+        print(f"[!] {collisions} {label} share their key {keys} with another row, all kept")
+
+    return collisions
 
 
 def slice_history (
@@ -349,6 +402,10 @@ def slice_history (
 
 
 
+# One writer at a time for the cache file (bank functions run in a thread pool)
+_CACHE_WRITE_LOCK = threading.RLock()
+
+
 def load_cache (
 
         cache_filename : Optional[str] = None,
@@ -374,7 +431,6 @@ def load_cache (
 
     try :
         data = pl.read_csv(cache_filename, schema=schema_overrides)
-        print(data)
         return data
     except Exception as e :
         print(f"{e}")
@@ -382,6 +438,28 @@ def load_cache (
 
 
 
+def write_atomic (path : str, write : Callable[[str], Any]) -> None :
+    """
+    Write a file through a temp file of the same directory then rename it over `path`,
+    so a reader never sees a partial file. `write` receives the temp path. The temp name
+    is unique per process and thread; it is removed and the error raised if the write fails.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    try :
+
+        write(tmp)
+        os.replace(tmp, path)
+
+    except Exception :
+
+        if os.path.exists(tmp) :
+            os.remove(tmp)
+
+        raise
+
+
 def save_cache (
         
         full_cache : Optional[pl.DataFrame] = None,
@@ -391,22 +469,37 @@ def save_cache (
 
     ) -> bool :
     """
-    
+    Merge cache_df rows into the cache file.
+
+    Safe under threads (one writer at a time) and atomic : the merged cache is written to a
+    temp file then renamed over the cache file, so a reader never sees a half-written CSV.
+    When full_cache is None the file is re-read under the lock, so rows written meanwhile
+    by another writer are kept instead of being clobbered by a stale snapshot.
     """
     if cache_df is None :
         return False
     
-    full_cache = load_cache() if full_cache is None else full_cache
-    #print(full_cache)
     cache_filename = CACHE_FILENAME_ABS if cache_filename is None else cache_filename
- 
-    merged_df = pl.concat([full_cache, cache_df], how="vertical")
 
-    try :
-        merged_df.write_csv(cache_filename)
-    
-    except :
-        return False
+    with _CACHE_WRITE_LOCK :
+
+        full_cache = load_cache(cache_filename) if full_cache is None else full_cache
+
+        if full_cache is None :
+            return False
+
+        merged_df = (
+            pl.concat([full_cache, cache_df.select(full_cache.columns)], how="vertical_relaxed")
+            .unique(subset=["Date", "Bank", "Fundation", "Kind"], keep="last", maintain_order=True)
+        )
+
+        try :
+            write_atomic(cache_filename, merged_df.write_csv)
+        
+        except Exception as e :
+
+            print(f"[-] Failed writing cache {cache_filename}: {e}")
+            return False
     
     return True
 
@@ -461,9 +554,8 @@ def cache_load_row (
     
     """
     cache_df = load_cache() if cache_df is None else cache_df
-    print(cache_df)
+
     if cache_df is None or cache_df.is_empty() :
-        print("were are hereeeee")
         return pl.DataFrame()
 
     existing_row = cache_df.filter(
@@ -529,7 +621,6 @@ def cache_update (
         }
 
     )
-    print(row)
 
     # Verify if the this results already exists
     if cache_row_exists(cache_df, bank, kind, fund, date) :
@@ -537,10 +628,150 @@ def cache_update (
         print("The row Already exists, no update")
         return False
     
-    # Save the new row to the cache
+    # Save the new row to the cache (re-read under the write lock, never from the snapshot)
     
-    save_cache(cache_df, row)
+    save_cache(None, row)
 
     return True
 
 
+class FileCache :
+    """
+    Process-wide view of the file cache (CSV of Date, Bank, Fundation, Kind, Filename).
+
+    The CSV is read once, then lookups go through an in-memory hash index on
+    (Bank, Kind, Fundation, Date). New rows are buffered and written behind by `flush`
+    (called at the end of a run, and at interpreter exit). Safe to share between the
+    threads of run_all_in_parallel.
+    """
+
+    def __init__ (
+
+            self,
+            cache_filename : Optional[str] = None,
+            schema_overrides : Optional[Dict] = None,
+
+        ) -> None :
+
+        self.cache_filename = CACHE_FILENAME_ABS if cache_filename is None else cache_filename
+        self.schema_overrides = CACHE_COLUMNS if schema_overrides is None else schema_overrides
+
+        self._lock = threading.RLock()
+        self._index : Optional[Dict[Tuple[str, str, str, dt.date], str]] = None
+        self._pending : List[Dict] = []
+
+
+    @staticmethod
+    def _key (bank : str, kind : str, fund : str, date : Optional[str | dt.datetime | dt.date]) -> Tuple :
+        return (bank, kind, fund, str_to_date(date_to_str(date)))
+
+
+    def _ensure_loaded (self) -> Dict[Tuple[str, str, str, dt.date], str] :
+
+        if self._index is not None :
+            return self._index
+
+        self._index = {}
+        cache_df = load_cache(self.cache_filename, self.schema_overrides)
+
+        if cache_df is None or cache_df.is_empty() :
+            return self._index
+
+        for date, bank, fund, kind, filename in cache_df.select(["Date", "Bank", "Fundation", "Kind", "Filename"]).iter_rows() :
+            # first row wins, as with the previous filter(...).item() lookups
+            self._index.setdefault((bank, kind, fund, date), filename)
+
+        return self._index
+
+
+    def lookup (
+
+            self,
+            bank : Optional[str] = None,
+            kind : str = "cash",
+            fund : str = "HV",
+            date : Optional[str | dt.datetime | dt.date] = None,
+            dir_abs_path : Optional[str] = None,
+
+        ) -> Optional[str] :
+        """
+        Cached filename for (bank, kind, fund, date), or None.
+        With dir_abs_path, a filename that no longer exists in that directory is ignored.
+        """
+        with self._lock :
+            filename = self._ensure_loaded().get(self._key(bank, kind, fund, date))
+
+        if filename is not None and dir_abs_path is not None and not os.path.exists(os.path.join(dir_abs_path, filename)) :
+            return None
+
+        return filename
+
+
+    def add (
+
+            self,
+            date : Optional[str | dt.datetime | dt.date] = None,
+            bank : Optional[str] = None,
+            fund : str = "HV",
+            kind : str = "cash",
+            filename : Optional[str] = None,
+
+        ) -> bool :
+        """
+        Record a filename. Returns False if the same filename is already cached for the key.
+        The row reaches the disk on the next flush.
+        """
+        key = self._key(bank, kind, fund, date)
+
+        with self._lock :
+
+            index = self._ensure_loaded()
+
+            if index.get(key) == filename :
+                return False
+
+            index[key] = filename
+            self._pending.append(
+                {"Date" : key[3], "Bank" : bank, "Fundation" : fund, "Kind" : kind, "Filename" : filename}
+            )
+
+        return True
+
+
+    def flush (self) -> bool :
+        """
+        Write the buffered rows to the cache file.
+        """
+        with self._lock :
+
+            if not self._pending :
+                return True
+
+            rows = pl.DataFrame(self._pending, schema=self.schema_overrides)
+
+            if not save_cache(None, rows, self.cache_filename) :
+                return False
+
+            self._pending.clear()
+
+        return True
+
+
+_FILE_CACHE : Optional[FileCache] = None
+_FILE_CACHE_LOCK = threading.Lock()
+
+
+def get_file_cache () -> FileCache :
+    """
+    Return the process-wide file cache (created, and its CSV loaded, on first use).
+    """
+    global _FILE_CACHE
+
+    with _FILE_CACHE_LOCK :
+
+        if _FILE_CACHE is None :
+
+            _FILE_CACHE = FileCache()
+            atexit.register(_FILE_CACHE.flush)
+
+        return _FILE_CACHE
@@ -0,0 +1,32 @@
+import os
+import tempfile
+
+# src.config reads its settings from the environment at import time
+for _name in ("MS", "GS", "SAXO", "EDB", "UBS") :
+    for _suffix in ("EMAILS", "SUBJECT_WORDS", "FILENAMES") :
+        os.environ.setdefault(f"{_name}_{_suffix}", "")
+
+os.environ.setdefault("CACHE_DIR_ABS_PATH", tempfile.gettempdir())
+os.environ.setdefault("CACHE_FILE_NAME", "cache.json")
+
+import polars as pl
+
+from src.mail_sync import MailSyncState
+
+
+def _inbox (rows) :
+    return pl.DataFrame(rows, schema={"Shared Email" : pl.Utf8, "Id" : pl.Utf8, "Received DateTime" : pl.Utf8}, orient="row")
+
+
+def test_watermark_stays_before_failed_message () :
+
+    inbox = _inbox([
+        ("box@example.com", "m1", "2025-03-04T08:00:00Z"),
+        ("box@example.com", "m2", "2025-03-04T09:00:00Z"),
+    ])
+
+    state = MailSyncState()
+    state.mark_processed(inbox.filter(pl.col("Id") == "m2"), inbox.filter(pl.col("Id") == "m1"))
+
+    assert state.watermark("box@example.com", "2025-03-04") <= "2025-03-04T08:00:00Z"
+    assert state.new_messages(inbox)["Id"].to_list() == ["m1"]